@@ -1,3 +1,5 @@
+from types import MappingProxyType
+
 import numpy as np
 
 from .geom_utils import Extent
@@ -14,21 +16,21 @@ SOURCE_DATASET_FIELD_NAME = 'source_dataset'
 TABLE_NAME_PREFIX = 'db_'
 WEB_MERCATOR_SRID = 3857
 
-PANDAS_TYPE_CONVERSION = {
+PANDAS_TYPE_CONVERSION = MappingProxyType({
     'decimal': np.float64,
     'date': np.datetime64,
     'integer': np.int64,
-    'string': np.str,
+    'string': str,
     'xlocation': np.float64,
     'ylocation': np.float64,
-    'dropdownedit': np.str,
-    'dropdown': np.str,
+    'dropdownedit': str,
+    'dropdown': str,
     'double': np.float64,
-    'image': np.str,
-    'text': np.str,
+    'image': str,
+    'text': str,
     'timestamp': np.datetime64
-}
-POSTGIS_ESRI_FIELD_MAPPING = {
+})
+POSTGIS_ESRI_FIELD_MAPPING = MappingProxyType({
     'bigint': 'esriFieldTypeInteger',
     'smallint': 'esriFieldTypeSmallInteger',
     'boolean': 'esriFieldTypeSmallInteger',
@@ -43,7 +45,7 @@ POSTGIS_ESRI_FIELD_MAPPING = {
     'Geometry': 'esriFieldTypeGeometry',
     'Unknown': 'esriFieldTypeString',
     'OID': 'esriFieldTypeOID',
-}
+})
 
 # Adjusted global extent -- adjusted to better fit screen layout. Same as mapController.getAdjustedGlobalExtent().
 ADJUSTED_GLOBAL_EXTENT = Extent({
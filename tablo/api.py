@@ -1,28 +1,212 @@
-import json
+import datetime
+import hashlib
+import hmac
 import logging
 
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
 from django.conf.urls import url
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import Http404
+from django.db import DatabaseError, transaction
+from django.db.models import Prefetch, signals
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.encoding import force_str
 from tastypie import fields
 from tastypie.authentication import MultiAuthentication, SessionAuthentication, ApiKeyAuthentication
 from tastypie.authorization import DjangoAuthorization
+from tastypie.bundle import Bundle
 from tastypie.compat import NoReverseMatch
 from tastypie.constants import ALL
-from tastypie.exceptions import ImmediateHttpResponse
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
 from tastypie.http import HttpBadRequest
+from tastypie.models import ApiKey
 from tastypie.resources import ModelResource
 from tastypie.serializers import Serializer
 from tastypie.utils import trailing_slash
+from tastypie.utils.mime import build_content_type
 
+from . import json_compat
 from .csv_utils import prepare_csv_rows
 from .exceptions import BAD_DATA, derive_error_response_data, InvalidFileError
 from .models import Column, FeatureService, FeatureServiceLayer, FeatureServiceLayerRelations, TemporaryFile
-from .models import add_geometry_column, populate_point_data, populate_aggregate_table
-from .models import copy_data_table_for_import, create_aggregate_database_table, create_database_table
+from .models import add_geometry_column, add_geometry_index, populate_point_data, populate_aggregate_table
+from .models import copy_csv_to_database_table, copy_data_table_for_import, create_aggregate_database_table
+from .models import invalidate_table_data
 
 logger = logging.getLogger(__name__)
 
+# Users authenticated by API key are cached briefly, and invalidated whenever they or their keys change
+API_KEY_CACHE_KEY = 'tablo:api_key:{username}'
+API_KEY_CACHE_TIMEOUT = getattr(settings, 'TABLO_API_KEY_CACHE_TIMEOUT', 60)
+
+# Maximum number of distinct error messages logged for the failed features of a single edit
+MAX_LOGGED_ERRORS = 5
+
+# Reported for edits that succeeded but were undone, when apply_edits is called with ?atomic=1
+EDIT_ROLLED_BACK_MESSAGE = 'rolled back because another edit in the request failed'
+
+# Number of rows read to describe a CSV, so that describing a large upload does not read the whole file
+DESCRIBE_SAMPLE_SIZE = getattr(settings, 'TABLO_DESCRIBE_SAMPLE_SIZE', 10000)
+
+# List responses with at least this many objects are streamed, rather than serialized in memory all at once
+STREAMING_LIST_THRESHOLD = 100
+
+# Resolved once: the trailing slash setting does not change while the URL configuration is loaded
+TRAILING_SLASH = trailing_slash()
+
+# Custom feature service endpoints, routed by their names with dashes in place of underscores
+SERVICE_ENDPOINTS = ('finalize', 'copy', 'combine_tables', 'apply_edits')
+SERVICE_ENDPOINT_URL = r'^(?P<resource_name>{resource_name})/(?P<service_id>[\w\-@\._]+)/{endpoint}'
+
+# Custom temporary file endpoints: deploy and append also take the dataset the file is loaded into
+DATASET_URL_SEGMENT = r'(?P<dataset_id>[\w\-@\._]+)/'
+TEMPORARY_FILE_ENDPOINTS = (('describe', ''), ('deploy', DATASET_URL_SEGMENT), ('append', DATASET_URL_SEGMENT))
+TEMPORARY_FILE_ENDPOINT_URL = r'^(?P<resource_name>{resource_name})/(?P<{uri_name}>.*?)/{dataset}{endpoint}{slash}$'
+
+# Layers are prefetched in primary key order, so that calls to first() are served from the prefetched results
+SERVICE_LAYERS_PREFETCH = Prefetch('featureservicelayer_set', queryset=FeatureServiceLayer.objects.order_by('pk'))
+
+
+def parse_edits(value):
+    """ :return: the list of edits in a JSON encoded POST value, without parsing when none were sent """
+    return json_compat.loads(value) if value else []
+
+
+def get_edit_results(results, action):
+    """ Converts the results of a bulk edit, either primary keys or errors, to ArcGIS style edit results """
+
+    edit_results = []
+    failures = []
+    for result in results:
+        if isinstance(result, Exception):
+            failures.append(result)
+            edit_results.append({
+                'success': False,
+                'error': {
+                    'code': -999999,
+                    'description': 'Error {0} feature: {1}'.format(action, result)
+                }
+            })
+        else:
+            edit_results.append({
+                'objectId': result,
+                'success': True
+            })
+
+    # Only the first failure is logged with its traceback: the rest are usually the same error repeated
+    if failures:
+        logger.error('Error {0} feature: {1}'.format(action, failures[0]), exc_info=failures[0])
+    if len(failures) > 1:
+        distinct_errors = list(OrderedDict.fromkeys(str(e) for e in failures[1:]))
+        logger.warning('{0} additional failures {1} features, including: {2}'.format(
+            len(failures) - 1, action, '; '.join(distinct_errors[:MAX_LOGGED_ERRORS])
+        ))
+
+    return edit_results
+
+
+def hash_api_key(api_key):
+    """ :return: a digest of an API key, so that keys themselves are not written to the cache """
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def invalidate_api_key(sender, instance, **kwargs):
+    """ Clears the cached authentication of a user whose account or API key has been changed or deleted """
+
+    user = instance.user if isinstance(instance, ApiKey) else instance
+    cache.delete(API_KEY_CACHE_KEY.format(username=user.get_username()))
+
+
+signals.post_save.connect(invalidate_api_key, sender=get_user_model())
+signals.post_delete.connect(invalidate_api_key, sender=get_user_model())
+signals.post_save.connect(invalidate_api_key, sender=ApiKey)
+signals.post_delete.connect(invalidate_api_key, sender=ApiKey)
+
+
+class CachedApiKeyAuthentication(ApiKeyAuthentication):
+    """
+    Remembers users authenticated by API key for ``TABLO_API_KEY_CACHE_TIMEOUT`` seconds, so that the user and key
+    are not looked up again for each request a client makes with the same key.
+    """
+
+    def is_authenticated(self, request, **kwargs):
+        try:
+            username, api_key = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+
+        if not username or not api_key:
+            return self._unauthorized()
+
+        cache_key = API_KEY_CACHE_KEY.format(username=username)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            key_digest, user = cached
+            if hmac.compare_digest(key_digest, hash_api_key(api_key)) and self.check_active(user):
+                request.user = user
+                return True
+
+        authenticated = super(CachedApiKeyAuthentication, self).is_authenticated(request, **kwargs)
+        if authenticated is True:
+            cache.set(cache_key, (hash_api_key(api_key), request.user), API_KEY_CACHE_TIMEOUT)
+
+        return authenticated
+
+
+class OrjsonSerializer(Serializer):
+    """ Serializes JSON with orjson, which is much faster than the json module for large responses """
+
+    def to_json(self, data, options=None):
+        return self.to_json_bytes(data, options).decode()
+
+    def to_json_bytes(self, data, options=None):
+        # orjson walks the data itself, rather than a copy made by to_simple: only bundles and values it does not
+        # support natively are simplified in Python. Keys are sorted, as they are by the default serializer.
+        return json_compat.dumps_bytes(data, default=self.simplify, sort_keys=True, passthrough_datetime=True)
+
+    def simplify(self, data):
+        """ Simplifies a value orjson cannot serialize, in the same way as ``to_simple`` """
+
+        if isinstance(data, Bundle):
+            return data.data
+        if isinstance(data, datetime.datetime):
+            return self.format_datetime(data)
+        if isinstance(data, datetime.date):
+            return self.format_date(data)
+        if isinstance(data, datetime.time):
+            return self.format_time(data)
+        return force_str(data)
+
+    def from_json(self, content):
+        try:
+            return json_compat.loads(content)
+        except ValueError:
+            raise BadRequest('Request is not valid JSON.')
+
+
+class StreamingListResponse(StreamingHttpResponse, HttpResponse):
+    """
+    A streamed response that is also an ``HttpResponse``, so that Tastypie returns it from ``dispatch`` rather than
+    replacing it with a 204. Its content is only ever streamed.
+    """
+
+    def __init__(self, streaming_content=(), *args, **kwargs):
+        # HttpResponse.__init__ would set content, which a streamed response cannot have
+        HttpResponseBase.__init__(self, *args, **kwargs)
+        self.streaming_content = streaming_content
+
+
+# Serializers hold no per-request state, so all resources share one
+SERIALIZER = OrjsonSerializer(formats=['json', 'jsonp'])
+
+# Neither does authentication. Sessions are checked first, so API keys are only looked up for requests without one.
+AUTHENTICATION = MultiAuthentication(SessionAuthentication(), CachedApiKeyAuthentication())
+
 
 class TabloModelResource(ModelResource):
 
@@ -37,6 +221,21 @@ class TabloModelResource(ModelResource):
         except NoReverseMatch:
             return ''
 
+    def create_data_response(self, request, data):
+        """
+        Returns plain response data, such as the results of custom endpoints. JSON is written directly with orjson,
+        since there are no bundles or objects to simplify first. Other formats are passed to ``create_response``.
+        """
+
+        desired_format = self.determine_format(request)
+        if desired_format != 'application/json':
+            return self.create_response(request, data)
+
+        return HttpResponse(
+            content=json_compat.dumps_bytes(data, default=str, sort_keys=True),
+            content_type=build_content_type(desired_format)
+        )
+
 
 class FeatureServiceResource(TabloModelResource):
     """
@@ -102,9 +301,11 @@ class FeatureServiceResource(TabloModelResource):
         resource_name = 'featureservice'
         list_allowed_methods = ['get', 'post']
         detail_allowed_methods = ['get', 'post', 'put', 'patch', 'delete']
-        serializer = Serializer(formats=['json', 'jsonp'])
-        queryset = FeatureService.objects.all()
-        authentication = MultiAuthentication(SessionAuthentication(), ApiKeyAuthentication())
+        serializer = SERIALIZER
+        queryset = FeatureService.objects.prefetch_related(
+            'featureservicelayer_set', 'featureservicelayer_set__featureservicelayerrelations_set'
+        )
+        authentication = AUTHENTICATION
         authorization = DjangoAuthorization()
 
     def post_list(self, request, **kwargs):
@@ -113,25 +314,11 @@ class FeatureServiceResource(TabloModelResource):
     def prepend_urls(self):
         return [
             url(
-                r'^(?P<resource_name>{0})/(?P<service_id>[\w\-@\._]+)/finalize'.format(
-                    self._meta.resource_name
-                ), self.wrap_view('finalize'), name="api_featureservice_finalize"
-            ),
-            url(
-                r'^(?P<resource_name>{0})/(?P<service_id>[\w\-@\._]+)/copy'.format(
-                    self._meta.resource_name
-                ), self.wrap_view('copy'), name="api_featureservice_copy"
-            ),
-            url(
-                r'^(?P<resource_name>{0})/(?P<service_id>[\w\-@\._]+)/combine-tables'.format(
-                    self._meta.resource_name
-                ), self.wrap_view('combine_tables'), name="api_featureservice_combine_tables"
-            ),
-            url(
-                r'^(?P<resource_name>{0})/(?P<service_id>[\w\-@\._]+)/apply-edits'.format(
-                    self._meta.resource_name
-                ), self.wrap_view('apply_edits'), name="api_featureservice_apply_edits"
+                SERVICE_ENDPOINT_URL.format(
+                    resource_name=self._meta.resource_name, endpoint=endpoint.replace('_', '-')
+                ), self.wrap_view(endpoint), name='api_featureservice_{}'.format(endpoint)
             )
+            for endpoint in SERVICE_ENDPOINTS
         ]
 
     def finalize(self, request, **kwargs):
@@ -144,138 +331,126 @@ class FeatureServiceResource(TabloModelResource):
 
         service_id = kwargs['service_id']
         try:
-            service = FeatureService.objects.get(id=service_id)
+            service = FeatureService.objects.prefetch_related(SERVICE_LAYERS_PREFETCH).get(id=service_id)
         except ObjectDoesNotExist:
             raise Http404('Invalid feature service id during finalize: {}'.format(service_id))
 
         service.finalize(service.dataset_id)
 
-        return self.create_response(request, {'status': 'good'})
+        return self.create_data_response(request, {'status': 'good'})
 
     def copy(self, request, **kwargs):
 
         service_id = kwargs['service_id']
         try:
-            service = FeatureService.objects.get(id=service_id)
+            service = FeatureService.objects.prefetch_related(SERVICE_LAYERS_PREFETCH).get(id=service_id)
         except ObjectDoesNotExist:
             raise Http404('Invalid feature service id during copy: {}'.format(service_id))
 
-        table_name = copy_data_table_for_import(service.dataset_id)
+        layers = list(service.featureservicelayer_set.all())
 
-        old_layers = service.featureservicelayer_set.all()
+        # The table, service and layers are copied together, so that a failure does not leave a partial copy
+        with transaction.atomic():
+            table_name = copy_data_table_for_import(service.dataset_id)
 
-        service.id = None
-        service._initial_extent = None
-        service._full_extent = None
+            # The copied table is identical to the original, so cached extents are carried over with the service
+            service.id = None
+            service.save()
 
-        service.save()
+            for layer in layers:
+                layer.id = None
+                layer.service = service
+                layer.table = table_name
 
-        for layer in old_layers:
-            layer.id = None
-            layer.service = service
-            layer._extent = None
-            layer._time_extent = None
-            layer.table = table_name
-            layer.save()
+            # Primary keys are set on the new layers by the single INSERT, which returns them on PostgreSQL.
+            # bulk_create does not call save, so the layers are told their new table is stored, and saving
+            # a computed extent does not clear the extents carried over.
+            FeatureServiceLayer.objects.bulk_create(layers)
+            for layer in layers:
+                layer.set_loaded_values()
 
-        return self.create_response(request, {
+        return self.create_data_response(request, {
             'service_id': service.id,
-            'time_extent': layer.time_extent
+            'time_extent': layers[-1].time_extent
         })
 
     def combine_tables(self, request, **kwargs):
 
         service_id = kwargs['service_id']
         try:
-            service = FeatureService.objects.get(id=service_id)
+            service = FeatureService.objects.prefetch_related(SERVICE_LAYERS_PREFETCH).get(id=service_id)
         except ObjectDoesNotExist:
             raise Http404('Invalid feature service id during combine_tables: {}'.format(service_id))
 
-        columns = json.loads(request.POST.get('columns'))
+        columns = json_compat.loads(request.POST.get('columns'))
         row_columns = [Column(column=col['name'], type=col['type'], required=col['required']) for col in columns]
-        dataset_list = json.loads(request.POST.get('dataset_list'))
+        dataset_list = json_compat.loads(request.POST.get('dataset_list'))
         table_name = create_aggregate_database_table(row_columns, service.dataset_id)
 
-        add_geometry_column(service.dataset_id)
+        add_geometry_column(service.dataset_id, create_index=False)
         populate_aggregate_table(table_name, row_columns, dataset_list)
+        add_geometry_index(service.dataset_id)
 
         service._full_extent = None
         service._initial_extent = None
-        service.featureservicelayer_set.first()._extent = None
-        service.save()
+        service.save(update_fields=['_full_extent', '_initial_extent'])
 
-        return self.create_response(request, {'table_name': table_name})
+        # The layers all read from the rebuilt table, so their cached extents are cleared with a single UPDATE
+        FeatureServiceLayer.objects.filter(service=service).update(_extent=None, _time_extent=None)
+
+        return self.create_data_response(request, {'table_name': table_name})
 
     def apply_edits(self, request, **kwargs):
 
         service_id = kwargs['service_id']
         try:
-            service = FeatureService.objects.get(id=service_id)
+            service = FeatureService.objects.prefetch_related(SERVICE_LAYERS_PREFETCH).get(id=service_id)
         except ObjectDoesNotExist:
             raise Http404('Invalid feature service id during apply_edits: {}'.format(service_id))
 
-        adds = json.loads(request.POST.get('adds', '[]'))
-        updates = json.loads(request.POST.get('updates', '[]'))
-        delete_list = request.POST.get('deletes', None)
-        deletes = str(delete_list).split(',') if delete_list else []
+        adds = parse_edits(request.POST.get('adds'))
+        updates = parse_edits(request.POST.get('updates'))
+        try:
+            deletes = [int(pk) for pk in request.POST.get('deletes', '').split(',') if pk.strip()]
+        except ValueError:
+            raise BadRequest('Invalid deletes: object ids must be integers')
+
+        if not (adds or updates or deletes):
+            return self.create_data_response(request, {'addResults': [], 'updateResults': [], 'deleteResults': []})
 
-        add_response_obj = []
         feature_service_layer = service.featureservicelayer_set.first()
+
+        # Adds and deletes may move the time extent, but updates only do if they set the time field
+        time_field = (feature_service_layer.start_time_field or '').lower()
+        updates_time = [bool(time_field) and time_field in (f.get('attributes') or {}) for f in updates]
         original_time_extent = (
-            feature_service_layer.get_raw_time_extent() if feature_service_layer.supports_time else None
+            json_compat.loads(feature_service_layer.time_extent)
+            if feature_service_layer.supports_time and (adds or deletes or any(updates_time)) else None
         )
-        for feature in adds:
-            try:
-                object_id = feature_service_layer.add_feature(feature)
-                add_response_obj.append({
-                    'objectId': object_id,
-                    'success': True
-                })
-            except Exception as e:
-                logger.exception(e)
-                add_response_obj.append({
-                    'success': False,
-                    'error': {
-                        'code': -999999,
-                        'description': 'Error adding feature: {}'.format(e)
-                    }
-                })
-
-        update_response_obj = []
-        for feature in updates:
-            try:
-                object_id = feature_service_layer.update_feature(feature)
-                update_response_obj.append({
-                    'objectId': object_id,
-                    'success': True
-                })
-            except Exception as e:
-                logger.exception(e)
-                update_response_obj.append({
-                    'success': False,
-                    'error': {
-                        'code': -999999,
-                        'description': 'Error updating feature: {}'.format(e)
-                    }
-                })
-
-        delete_response_obj = []
-        for object_id in deletes:
-            try:
-                object_id = feature_service_layer.delete_feature(object_id)
-                delete_response_obj.append({
-                    'objectId': object_id,
-                    'success': True
-                })
-            except Exception as e:
-                logger.exception(e)
-                delete_response_obj.append({
-                    'success': False,
-                    'error': {
-                        'code': -999999,
-                        'description': 'Error deleting feature: {}'.format(e)
-                    }
-                })
+
+        # By default each failed edit is rolled back on its own. With ?atomic=1, a failure rolls back every edit.
+        all_or_nothing = request.GET.get('atomic') == '1'
+
+        with transaction.atomic():
+            edit_results = (
+                feature_service_layer.bulk_add_features(adds),
+                feature_service_layer.bulk_update_features(updates),
+                feature_service_layer.bulk_delete_features(deletes)
+            )
+
+            # Cached renderers no longer reflect the table once the edits are committed
+            transaction.on_commit(partial(invalidate_table_data, feature_service_layer.table))
+
+            if all_or_nothing and any(isinstance(r, Exception) for results in edit_results for r in results):
+                transaction.set_rollback(True)
+                edit_results = tuple(
+                    [r if isinstance(r, Exception) else DatabaseError(EDIT_ROLLED_BACK_MESSAGE) for r in results]
+                    for results in edit_results
+                )
+
+        add_response_obj = get_edit_results(edit_results[0], 'adding')
+        update_response_obj = get_edit_results(edit_results[1], 'updating')
+        delete_response_obj = get_edit_results(edit_results[2], 'deleting')
 
         response_obj = {
             'addResults': add_response_obj,
@@ -283,16 +458,48 @@ class FeatureServiceResource(TabloModelResource):
             'deleteResults': delete_response_obj
         }
 
-        if original_time_extent:
-            new_time_extent = feature_service_layer.get_raw_time_extent()
+        # Only the invalidated extents are written, rather than every column of the service and layer
+        layer_update_fields = []
+
+        has_new_geometry = (
+            any(result['success'] for result in add_response_obj + delete_response_obj) or
+            any(result['success'] and f.get('geometry') for f, result in zip(updates, update_response_obj))
+        )
+        if has_new_geometry:
+            feature_service_layer._extent = None
+            layer_update_fields.append('_extent')
+            service._full_extent = None
+            service.save(update_fields=['_full_extent'])
+
+        added_ids = [result['objectId'] for result in add_response_obj if result['success']]
+        has_removed_times = (
+            any(result['success'] for result in delete_response_obj) or
+            any(result['success'] and t for t, result in zip(updates_time, update_response_obj))
+        )
+        if original_time_extent and (added_ids or has_removed_times):
+            if has_removed_times:
+                # The earliest or latest time may have been deleted or changed, so the whole layer is read
+                new_time_extent = feature_service_layer.get_raw_time_extent()
+            else:
+                # Adds can only widen the extent, so only the added features are read
+                added_time_extent = feature_service_layer.get_raw_time_extent(added_ids)
+                new_time_extent = [
+                    min((t for t in (original_time_extent[0], added_time_extent[0]) if t is not None), default=None),
+                    max((t for t in (original_time_extent[1], added_time_extent[1]) if t is not None), default=None)
+                ]
             has_new_time_extent = (
                 new_time_extent[0] != original_time_extent[0] or
                 new_time_extent[1] != original_time_extent[1]
             )
             if has_new_time_extent:
-                response_obj['new_time_extent'] = json.dumps(new_time_extent)
+                response_obj['new_time_extent'] = json_compat.dumps(new_time_extent)
+                feature_service_layer._time_extent = response_obj['new_time_extent']
+                layer_update_fields.append('_time_extent')
 
-        return self.create_response(request, response_obj)
+        if layer_update_fields:
+            feature_service_layer.save(update_fields=layer_update_fields)
+
+        return self.create_data_response(request, response_obj)
 
 
 class FeatureServiceLayerRelationsResource(TabloModelResource):
@@ -305,9 +512,9 @@ class FeatureServiceLayerRelationsResource(TabloModelResource):
         resource_name = 'featureservicelayerrelations'
         list_allowed_methods = ['get']
         detail_allowed_methods = ['get']
-        serializer = Serializer(formats=['json', 'jsonp'])
+        serializer = SERIALIZER
         queryset = FeatureServiceLayerRelations.objects.select_related('layer').all()
-        authentication = MultiAuthentication(SessionAuthentication(), ApiKeyAuthentication())
+        authentication = AUTHENTICATION
         authorization = DjangoAuthorization()
 
 
@@ -327,11 +534,73 @@ class FeatureServiceLayerResource(TabloModelResource):
         list_allowed_methods = ['get', 'post']
         detail_allowed_methods = ['get', 'post', 'put', 'patch', 'delete']
         detail_uri_name = 'id'
-        serializer = Serializer(formats=['json', 'jsonp'])
-        queryset = FeatureServiceLayer.objects.all()
-        authentication = MultiAuthentication(SessionAuthentication(), ApiKeyAuthentication())
+        serializer = SERIALIZER
+        queryset = FeatureServiceLayer.objects.select_related('service').prefetch_related(
+            'featureservicelayerrelations_set'
+        )
+        authentication = AUTHENTICATION
         authorization = DjangoAuthorization()
 
+    def get_list(self, request, **kwargs):
+        """
+        Overridden to stream large JSON lists: layers are dehydrated and written one at a time, so that the full
+        list, with the fields and relations of every layer, is never held in memory at once. The fields of the
+        layers in the page are loaded together beforehand.
+        """
+
+        desired_format = self.determine_format(request)
+        if desired_format != 'application/json':
+            return super(FeatureServiceLayerResource, self).get_list(request, **kwargs)
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        sorted_objects = self.apply_sorting(objects, options=request.GET)
+
+        collection_name = self._meta.collection_name
+        paginator = self._meta.paginator_class(
+            request.GET, sorted_objects, resource_uri=self.get_resource_uri(), limit=self._meta.limit,
+            max_limit=self._meta.max_limit, collection_name=collection_name
+        )
+        to_be_serialized = paginator.page()
+        page_objects = list(to_be_serialized[collection_name])
+
+        # The fields of every layer in the page are read together, instead of once for each layer as it is dehydrated
+        FeatureServiceLayer.prefetch_fields(page_objects)
+
+        if len(page_objects) < STREAMING_LIST_THRESHOLD:
+            to_be_serialized[collection_name] = [
+                self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True) for obj in page_objects
+            ]
+            to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+            return self.create_response(request, to_be_serialized)
+
+        def iter_bundles():
+            for obj in page_objects:
+                yield self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+
+        # The same hook is applied as above, with bundles that are only dehydrated as they are written
+        to_be_serialized[collection_name] = iter_bundles()
+        to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+
+        serializer = self._meta.serializer
+
+        def stream_list():
+            # Matches the default output, where keys are sorted, but writes the collection one bundle at a time
+            yield b'{'
+            for idx, (key, value) in enumerate(sorted(to_be_serialized.items())):
+                yield (b',' if idx else b'') + serializer.to_json_bytes(key) + b':'
+                if key != collection_name:
+                    yield serializer.to_json_bytes(value)
+                    continue
+
+                yield b'['
+                for bundle_idx, bundle in enumerate(value):
+                    yield (b',' if bundle_idx else b'') + serializer.to_json_bytes(bundle)
+                yield b']'
+            yield b'}'
+
+        return StreamingListResponse(stream_list(), content_type=build_content_type(desired_format))
+
 
 class TemporaryFileResource(TabloModelResource):
     uuid = fields.CharField(attribute='uuid', readonly=True)
@@ -341,34 +610,29 @@ class TemporaryFileResource(TabloModelResource):
         list_allowed_methods = ['get']
         detail_allowed_methods = ['get', 'delete']
         resource_name = 'temporary-files'
-        authentication = MultiAuthentication(SessionAuthentication(), ApiKeyAuthentication())
+        authentication = AUTHENTICATION
         authorization = DjangoAuthorization()
         fields = ['uuid', 'date', 'filename']
         detail_uri_name = 'uuid'
-        serializer = Serializer(formats=['json', 'jsonp'])
+        serializer = SERIALIZER
 
     def prepend_urls(self):
         return [
             url(
-                r"^(?P<resource_name>%s)/(?P<%s>.*?)/describe%s$" % (
-                    self._meta.resource_name, self._meta.detail_uri_name, trailing_slash()
-                ),
-                self.wrap_view('describe'), name='temporary_file_describe'
-            ),
-            url(
-                r"^(?P<resource_name>%s)/(?P<%s>.*?)/(?P<dataset_id>[\w\-@\._]+)/deploy%s$" % (
-                    self._meta.resource_name, self._meta.detail_uri_name, trailing_slash()
-                ),
-                self.wrap_view('deploy'), name='temporary_file_deploy'
-            ),
-            url(
-                r"^(?P<resource_name>%s)/(?P<%s>.*?)/(?P<dataset_id>[\w\-@\._]+)/append%s$" % (
-                    self._meta.resource_name, self._meta.detail_uri_name, trailing_slash()
-                ),
-                self.wrap_view('append'), name='temporary_file_append'
+                TEMPORARY_FILE_ENDPOINT_URL.format(
+                    resource_name=self._meta.resource_name, uri_name=self._meta.detail_uri_name,
+                    dataset=dataset, endpoint=endpoint, slash=TRAILING_SLASH
+                ), self.wrap_view(endpoint), name='temporary_file_{}'.format(endpoint)
             )
+            for endpoint, dataset in TEMPORARY_FILE_ENDPOINTS
         ]
 
+    def get_import_options(self, request):
+        """ :return: the CSV info and additional fields posted to deploy or append, parsed from one read of POST """
+
+        post = request.POST
+        return json_compat.loads(post.get('csv_info')), json_compat.loads(post.get('fields'))
+
     def populate_point_data(self, dataset_id, csv_info):
         srid = csv_info['srid']
         x_column = csv_info['xColumn']
@@ -403,7 +667,9 @@ class TemporaryFileResource(TabloModelResource):
                 fieldNames list.
 
             **optionalFields**
-                A list of fields that had empty values, and are taken to be optional.
+                A list of fields that had empty values, and are taken to be optional. Only the first
+                ``TABLO_DESCRIBE_SAMPLE_SIZE`` rows (10,000 by default) are read to find them: set the setting to
+                ``None`` to read the whole file.
 
             **xColumn**
                 The best guess at which column contains X spatial coordinates.
@@ -417,6 +683,9 @@ class TemporaryFileResource(TabloModelResource):
         """
         self.is_authenticated(request)
 
+        # Options are parsed before the file is looked up, so that malformed requests fail without a query
+        csv_info = json_compat.loads(request.POST.get('csv_info') or '{}') or None
+
         bundle = self.build_bundle(request=request)
         obj = self.obj_get(bundle, **self.remove_api_resource_names(kwargs))
 
@@ -428,19 +697,18 @@ class TemporaryFileResource(TabloModelResource):
 
         except InvalidFileError as e:
             raise ImmediateHttpResponse(HttpBadRequest(
-                content=json.dumps(derive_error_response_data(e, code=BAD_DATA)),
+                content=json_compat.dumps(derive_error_response_data(e, code=BAD_DATA)),
                 content_type='application/json'
             ))
 
-        csv_info = json.loads(request.POST.get('csv_info') or '{}') or None
-
-        prepared_csv = prepare_csv_rows(obj.file, csv_info)
+        with obj.file.open('rb') as csv_file:
+            prepared_csv = prepare_csv_rows(csv_file, csv_info, nrows=DESCRIBE_SAMPLE_SIZE)
         row_set = prepared_csv['row_set']
 
         if not len(row_set):
             raise ImmediateHttpResponse(
                 HttpBadRequest(
-                    content=json.dumps(
+                    content=json_compat.dumps(
                         derive_error_response_data(
                             InvalidFileError('File is empty', lines=0),
                             code=BAD_DATA
@@ -499,36 +767,38 @@ class TemporaryFileResource(TabloModelResource):
         try:
             dataset_id = kwargs.pop('dataset_id', None)
 
+            csv_info, additional_fields = self.get_import_options(request)
+
             bundle = self.build_bundle(request=request)
             obj = self.obj_get(bundle, **self.remove_api_resource_names(kwargs))
 
-            csv_info = json.loads(request.POST.get('csv_info'))
-            additional_fields = json.loads(request.POST.get('fields'))
-
-            prepared_csv = prepare_csv_rows(obj.file, csv_info)
+            # The import is committed once, so that a failure part way through leaves no partial table behind
+            with transaction.atomic():
+                # The file is opened once: the schema and the rows are read from the same handle, which is then closed
+                with obj.file.open('rb') as csv_file:
+                    table_name = copy_csv_to_database_table(
+                        csv_file,
+                        csv_info,
+                        dataset_id,
+                        additional_fields=additional_fields
+                    )
+                add_geometry_column(dataset_id, create_index=False)
+                self.populate_point_data(dataset_id, csv_info)
+                add_geometry_index(dataset_id)
 
-            table_name = create_database_table(
-                prepared_csv['row_set'],
-                csv_info,
-                dataset_id,
-                additional_fields=additional_fields
-            )
-            add_geometry_column(dataset_id)
-            self.populate_point_data(dataset_id, csv_info)
-
-            bundle.data['table_name'] = table_name
+                bundle.data['table_name'] = table_name
 
-            obj.delete()  # Temporary file has been moved to database, safe to delete
+                obj.delete()  # Temporary file has been moved to database, safe to delete
 
         except Exception as e:
-            logger.exception(e)
+            logger.exception('Error deploying file to dataset {0}'.format(dataset_id))
 
             raise ImmediateHttpResponse(HttpBadRequest(
-                content=json.dumps(derive_error_response_data(e)),
+                content=json_compat.dumps(derive_error_response_data(e)),
                 content_type='application/json'
             ))
 
-        return self.create_response(request, bundle)
+        return self.create_data_response(request, bundle.data)
 
     def append(self, request, **kwargs):
         self.is_authenticated(request)
@@ -536,32 +806,32 @@ class TemporaryFileResource(TabloModelResource):
         try:
             dataset_id = kwargs.pop('dataset_id', None)
 
+            csv_info, additional_fields = self.get_import_options(request)
+
             bundle = self.build_bundle(request=request)
             obj = self.obj_get(bundle, **self.remove_api_resource_names(kwargs))
 
-            csv_info = json.loads(request.POST.get('csv_info'))
-            additional_fields = json.loads(request.POST.get('fields'))
+            with transaction.atomic():
+                with obj.file.open('rb') as csv_file:
+                    table_name = copy_csv_to_database_table(
+                        csv_file,
+                        csv_info,
+                        dataset_id,
+                        append=True,
+                        additional_fields=additional_fields
+                    )
+                self.populate_point_data(dataset_id, csv_info)
 
-            prepared_csv = prepare_csv_rows(obj.file, csv_info)
-            table_name = create_database_table(
-                prepared_csv['row_set'],
-                csv_info,
-                dataset_id,
-                append=True,
-                additional_fields=additional_fields
-            )
-            self.populate_point_data(dataset_id, csv_info)
-
-            bundle.data['table_name'] = table_name
+                bundle.data['table_name'] = table_name
 
-            obj.delete()  # Temporary file has been moved to database, safe to delete
+                obj.delete()  # Temporary file has been moved to database, safe to delete
 
         except Exception as e:
-            logger.exception(e)
+            logger.exception('Error appending file to dataset {0}'.format(dataset_id))
 
             raise ImmediateHttpResponse(HttpBadRequest(
-                content=json.dumps(derive_error_response_data(e)),
+                content=json_compat.dumps(derive_error_response_data(e)),
                 content_type='application/json'
             ))
 
-        return self.create_response(request, bundle)
+        return self.create_data_response(request, bundle.data)
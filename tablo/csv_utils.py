@@ -1,13 +1,18 @@
+import codecs
 import csv
 import datetime
 import io
 import re
 
+from functools import lru_cache
+from itertools import islice
+
 from django.db.models.fields.files import FieldFile
 
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_integer_dtype
 
-POSTGRES_KEYWORDS = [
+POSTGRES_KEYWORDS = frozenset((
     'all', 'analyse', 'analyze', 'and', 'any', 'array', 'as', 'asc',
     'asymmetric', 'authorization', 'binary', 'both', 'case', 'cast', 'check', 'collate', 'collation',
     'column', 'concurrently', 'constraint', 'create', 'cross', 'current_catalog', 'current_date',
@@ -19,7 +24,7 @@ POSTGRES_KEYWORDS = [
     'outer', 'over', 'overlaps', 'placing', 'primary', 'references', 'returning', 'right', 'select',
     'session_user', 'similar', 'some', 'symmetric', 'table', 'then', 'to', 'trailing', 'true',
     'union', 'unique', 'user', 'using', 'variadic', 'verbose', 'when', 'where', 'window', 'with'
-]
+))
 
 X_AND_Y_FIELDS = (
     ('lon', 'lat'),
@@ -28,7 +33,25 @@ X_AND_Y_FIELDS = (
     ('east', 'north'),
     ('x_', 'y_')
 )
+X_AND_Y_PREFIX_LENGTHS = frozenset(len(guess) for guesses in X_AND_Y_FIELDS for guess in guesses)
+
+# Number of rows read with pandas when only the schema of a CSV is needed
+CSV_SAMPLE_SIZE = 1000
+
+# Values treated as missing when streaming rows: these match the defaults used by pandas.read_csv
+NULL_VALUES = frozenset((
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'
+))
 
+# Number of distinct headers for which the converted column name is remembered
+COLUMN_NAME_CACHE_SIZE = 4096
+
+COLUMN_NAME_SEPARATORS = str.maketrans({' ': '_', '-': '_'})
+NON_WORD_REGEX = re.compile(r'\W')
+NON_ASCII_REGEX = re.compile(r'[^\x00-\x7f]')
+
+# Formats of date columns, in order of preference: year first dates are read as ISO 8601 when ambiguous
 DATE_FORMATS = (
     '%m/%d/%Y',
     '%m/%d/%y',
@@ -38,14 +61,14 @@ DATE_FORMATS = (
     '%m-%d-%y',
     '%d-%m-%Y',
     '%d-%m-%y',
-    '%Y/%d/%m',
-    '%y/%d/%m',
     '%Y/%m/%d',
     '%y/%m/%d',
-    '%Y-%d-%m',
-    '%y-%d-%m',
+    '%Y/%d/%m',
+    '%y/%d/%m',
     '%Y-%m-%d',
-    '%y-%m-%d'
+    '%y-%m-%d',
+    '%Y-%d-%m',
+    '%y-%d-%m'
 )
 
 
@@ -54,38 +77,60 @@ def clean_header_row(header):
     return header.lstrip('\ufeff')
 
 
-def prepare_csv_rows(csv_file, csv_info=None):
+def read_csv_header(csv_file):
+    """
+    :return: the column names in the header row of a CSV, as ``prepare_csv_rows`` names them: pandas parses the
+    header, so that duplicate names are made unique the same way, and columns without a name are removed.
+    """
+
     if isinstance(csv_file, str):
         with open(csv_file, 'r') as f:
-            header_line = [clean_header_row(f.readline())]
-    elif isinstance(csv_file, (io.BufferedIOBase, io.StringIO)):
-        csv_file.seek(0)
-        header_line = [clean_header_row(csv_file.readline())]
-        csv_file.seek(0)
-    elif isinstance(csv_file, (FieldFile, io.BytesIO)):
+            header_line = f.readline()
+    elif isinstance(csv_file, (FieldFile, io.IOBase)):
         csv_file.seek(0)
-        header_line = [clean_header_row(csv_file.readline().decode())]
+        header_line = csv_file.readline()
         csv_file.seek(0)
     else:
         raise TypeError('Invalid csv file')
 
-    reader = csv.reader(header_line)
-    headers = [c for c in next(reader) if c]  # remove empty column names
+    if isinstance(header_line, bytes):
+        header_line = header_line.decode()
+
+    header_line = clean_header_row(header_line)
+    if not header_line.strip():
+        return []
+
+    columns = pd.read_csv(io.StringIO(header_line), dtype='object', engine='c', skipinitialspace=True, nrows=0).columns
+    return get_named_columns(columns)
 
+
+def get_named_columns(columns):
+    """ :return: the columns given names by the header, rather than named by their position by pandas """
+
+    return [c for idx, c in enumerate(columns) if c != 'Unnamed: {}'.format(idx)]
+
+
+def prepare_csv_rows(csv_file, csv_info=None, nrows=None):
     kwargs = {
-        'usecols': headers,
         'skip_blank_lines': True,
-        'skipinitialspace': True
+        'skipinitialspace': True,
+        'nrows': nrows
     }
 
-    row_set = pd.read_csv(csv_file, dtype='object', **kwargs)
+    if not isinstance(csv_file, str):
+        csv_file.seek(0)
+
+    # Pandas parses the header itself, and names columns without a header by their position
+    row_set = pd.read_csv(csv_file, dtype='object', engine='c', **kwargs)
+    named_columns = get_named_columns(row_set.columns)
+    row_set.drop(columns=[c for c in row_set.columns if c not in named_columns], inplace=True)
     row_set.dropna(how="all", inplace=True)
     row_set.rename(columns={c: convert_header_to_column_name(c) for c in row_set.columns}, inplace=True)
 
     if csv_info:
         date_fields = get_date_fields(csv_info)
         for field in date_fields:
-            row_set[field] = row_set[field].astype('datetime64')
+            row_set[field] = row_set[field].astype('datetime64[ns]')
 
     row_set.index += 1
     data_types = infer_data_types(row_set)
@@ -100,6 +145,121 @@ def prepare_csv_rows(csv_file, csv_info=None):
     }
 
 
+def infer_csv_schema(csv_file, csv_info=None, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Reads only the head of a CSV with pandas to derive its schema. If data types are provided in ``csv_info``,
+    as they are for deploy and append, nothing is inferred and only the header row is read.
+
+    :return: a tuple of converted column names and their data types
+    """
+
+    if csv_info and csv_info.get('dataTypes'):
+        # Nothing needs to be inferred, so only the header is read
+        columns = [convert_header_to_column_name(c) for c in read_csv_header(csv_file)]
+        return columns, csv_info['dataTypes']
+
+    prepared_csv = prepare_csv_rows(csv_file, csv_info, nrows=sample_size)
+    return list(prepared_csv['row_set'].columns), prepared_csv['data_types']
+
+
+def iter_csv_rows(csv_file):
+    """
+    Streams the rows of a CSV without loading the file into memory. Values are stripped, and missing values
+    are returned as None. Blank rows are skipped, as are columns without a header, as in ``prepare_csv_rows``.
+    """
+
+    if isinstance(csv_file, str):
+        with open(csv_file, 'r', newline='') as f:
+            yield from _iter_csv_lines(f)
+    elif isinstance(csv_file, io.TextIOBase):
+        csv_file.seek(0)
+        yield from _iter_csv_lines(csv_file)
+    elif isinstance(csv_file, (FieldFile, io.BufferedIOBase)):
+        csv_file.seek(0)
+        yield from _iter_csv_lines(codecs.iterdecode(csv_file, 'utf-8'))
+    else:
+        raise TypeError('Invalid csv file')
+
+
+def _iter_csv_lines(lines):
+    reader = csv.reader(lines, skipinitialspace=True)
+
+    header = next(reader, [])
+    if header:
+        header[0] = clean_header_row(header[0])
+    indexes = [idx for idx, c in enumerate(header) if c]  # remove empty column names
+    num_columns = len(header)
+
+    # This runs once per cell, so lookups are bound to locals outside of the loop
+    null_values = NULL_VALUES
+    strip = str.strip
+
+    for row in reader:
+        if len(row) < num_columns:
+            row = row + [''] * (num_columns - len(row))
+
+        values = [strip(row[idx]) for idx in indexes]
+        values = [None if value in null_values else value for value in values]
+
+        if any(v is not None for v in values):
+            yield values
+
+
+def iso_date_converter(date_format=None):
+    """
+    Returns a function that converts the date strings of one CSV column to ISO 8601, so that they are not parsed by
+    the DateStyle of the database when copied. Values are read with ``date_format``, as found for the column by
+    ``detect_date_format``, and any that do not match it are parsed by pandas, as imports once were.
+    """
+
+    def convert(value):
+        if value is None:
+            return None
+
+        if date_format is not None:
+            try:
+                return datetime.datetime.strptime(value, date_format).isoformat()
+            except ValueError:
+                pass
+
+        parsed = pd.Timestamp(value)
+        if parsed is pd.NaT:
+            return None
+        if parsed.tzinfo is not None:
+            parsed = parsed.tz_convert(None)
+        return parsed.isoformat()
+
+    return convert
+
+
+class CSVRowStream(object):
+    """ A read-only file-like object that writes rows as CSV on demand, for use with ``COPY ... FROM STDIN`` """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+
+        data = self.buffer.getvalue()
+        if size < 0 or len(data) <= size:
+            chunk, remainder = data, ''
+        else:
+            chunk, remainder = data[:size], data[size:]
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(remainder)
+
+        return chunk
+
+
 def infer_data_types(row_set):
     data_types = []
     for c in row_set.columns:
@@ -110,37 +270,66 @@ def infer_data_types(row_set):
             continue
 
         # If csv is loadded with csv_info, then given date columns are already parsed and we can continue
-        if column_series.dtype.name.lower().startswith('date'):
+        if is_datetime64_any_dtype(column_series.dtype):
             data_types.append('Date')
             continue
 
-        first_value = column_series.loc[1]
-        is_date_type = False
-
-        for fmt in DATE_FORMATS:
-            try:
-                datetime.datetime.strptime(first_value, fmt)
-                is_date_type = True
-                data_types.append('Date')
-                break
-            except (ValueError, TypeError):
-                pass
-
-        if is_date_type:
+        if detect_date_format(non_empty_rows) is not None:
+            data_types.append('Date')
             continue
 
         try:
-            data_type = pd.to_numeric(non_empty_rows).dtype.name.lower()
-            if 'int' in data_type:
-                data_types.append('Integer')
-            elif 'float' in data_type:
-                data_types.append('Decimal')
+            numeric_type = pd.to_numeric(non_empty_rows).dtype
+            data_types.append('Integer' if is_integer_dtype(numeric_type) else 'Decimal')
         except ValueError:
             data_types.append('String')
 
     return data_types
 
 
+def detect_date_format(values):
+    """
+    :param values: a series of the non-empty values of a column
+    :return: the first of ``DATE_FORMATS`` that parses every value, or None if there is none
+    """
+
+    # The first value rules out most formats cheaply, but a format is only used if it parses the whole column
+    first_value = values.iloc[0]
+
+    for fmt in DATE_FORMATS:
+        try:
+            datetime.datetime.strptime(first_value, fmt)
+        except (ValueError, TypeError):
+            continue
+
+        if pd.to_datetime(values, format=fmt, errors='coerce', cache=True).notna().all():
+            return fmt
+
+    return None
+
+
+def detect_csv_date_formats(csv_file, indexes, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Finds the format of each date column from the head of a streamed CSV, as ``infer_data_types`` does for the
+    columns it reads with pandas, so that every value in a column is read with the same format.
+
+    :return: the format of the column at each of ``indexes``, or None where no format parses the sampled values
+    """
+
+    rows = iter_csv_rows(csv_file)
+    try:
+        sample = list(islice(rows, sample_size))
+    finally:
+        rows.close()
+
+    date_formats = []
+    for idx in indexes:
+        values = pd.Series([row[idx] for row in sample if row[idx] is not None], dtype='object')
+        date_formats.append(detect_date_format(values) if len(values) else None)
+
+    return date_formats
+
+
 def get_date_fields(csv_info):
     fields = csv_info['fieldNames']
     data_types = csv_info['dataTypes']
@@ -148,38 +337,37 @@ def get_date_fields(csv_info):
 
 
 def determine_optional_fields(row_set):
-    return list(c for c in row_set.columns if row_set[c].isnull().values.any())
+    # Nulls are found for all columns with one reduction over the frame, rather than one per column
+    return row_set.columns[row_set.isnull().values.any(axis=0)].to_list()
 
 
 def determine_x_and_y_fields(columns):
-    x_field = None
-    y_field = None
+    # Columns are indexed by their prefixes once, with the last matching column taking precedence for each guess
+    columns_by_prefix = {}
+    for column in columns:
+        lowered = column.lower()
+        for length in X_AND_Y_PREFIX_LENGTHS:
+            columns_by_prefix[lowered[:length]] = column
 
     for x_guess, y_guess in X_AND_Y_FIELDS:
-        for column in columns:
-            if column.lower().startswith(x_guess):
-                x_field = column
-            if column.lower().startswith(y_guess):
-                y_field = column
+        x_field = columns_by_prefix.get(x_guess)
+        y_field = columns_by_prefix.get(y_guess)
+
+        # Only a valid guess if both the x field and y field are defined
         if x_field and y_field:
-            break
-        else:
-            # Only a valid guess if both the x field and y field are defined
-            x_field = None
-            y_field = None
+            return x_field, y_field
 
-    return x_field, y_field
+    return None, None
 
 
+@lru_cache(maxsize=COLUMN_NAME_CACHE_SIZE)
 def convert_header_to_column_name(header):
-    converted_header = header.lower()
-    converted_header = converted_header.replace(' ', '_')
-    converted_header = converted_header.replace('-', '_')
-    converted_header = re.sub(r'\W', '', converted_header)
+    converted_header = header.lower().translate(COLUMN_NAME_SEPARATORS)
+    converted_header = NON_WORD_REGEX.sub('', converted_header)
     converted_header = converted_header.strip('_')
 
     # Remove non-ascii characters
-    converted_header = re.sub(r'[^\x00-\x7f]', '', converted_header)
+    converted_header = NON_ASCII_REGEX.sub('', converted_header)
 
     if converted_header[0].isdigit():
         converted_header = 'f_' + converted_header
@@ -190,22 +378,20 @@ def convert_header_to_column_name(header):
 
 
 def prepare_row_set_for_import(row_set, csv_info):
-    for idx, data_type in enumerate(row_set.dtypes):
-        if data_type.name == 'object':
-            column = row_set.columns[idx]
-            row_set[column] = row_set[column].str.strip()
+    # Every string column is stripped in one pass, whatever data type it is imported as
+    str_columns = row_set.select_dtypes(include='object').columns
+    row_set[str_columns] = row_set[str_columns].apply(lambda column: column.str.strip())
 
     for idx, column in enumerate(row_set.columns):
         # We do not need to update date fields, because they are parsed by pandas on import
         csv_data_type = csv_info['dataTypes'][idx].lower()
         if csv_data_type == 'integer':
-            # Determine the smallest int type and use the relevant pandas nullable integer type
-            non_empty_rows = row_set[column][~row_set[column].isnull()]
-            int_type = pd.to_numeric(non_empty_rows, downcast='integer').dtype.name
-            row_set[column] = pd.to_numeric(row_set[column]).astype(int_type.capitalize())
+            # Determine the smallest int type and use the relevant pandas nullable integer type. The column is only
+            # parsed once: the smallest type is found from the values already parsed.
+            numeric_column = pd.to_numeric(row_set[column])
+            int_type = pd.to_numeric(numeric_column.dropna(), downcast='integer').dtype.name
+            row_set[column] = numeric_column.astype(int_type.capitalize())
         elif csv_data_type == 'decimal':
             row_set[column] = pd.to_numeric(row_set[column], downcast='float')
-        elif csv_data_type in ('string', 'empty'):
-            row_set[column] = row_set[column].str.strip()
 
     return row_set
@@ -1,4 +1,3 @@
-import json
 import copy
 import re
 
@@ -6,12 +5,16 @@ from pyproj import Proj, transform
 from math import sqrt, fabs, cos, radians
 from itertools import product
 
+from . import json_compat
+
 GLOBAL_EXTENT_WEB_MERCATOR = (-20037508.342789244, -20037342.166152496, 20037508.342789244, 20037342.16615247)
 SQL_BOX_REGEX = re.compile('BOX\((.*) (.*),(.*) (.*)\)')
 
 
 class SpatialReference(object):
 
+    __slots__ = ('wkid', 'wkt', 'srs', 'latest_wkid')
+
     def __init__(self, spatial_reference=None):
         self.wkid = None         # ESRI WKID
         self.wkt = None          # ESRI WKT
@@ -46,7 +49,7 @@ class SpatialReference(object):
         return None
 
     def as_json_string(self):  # ESRI format
-        return json.dumps(self.as_dict())
+        return json_compat.dumps(self.as_dict())
 
     def is_web_mercator(self):
         return (
@@ -68,11 +71,13 @@ class SpatialReference(object):
 class Extent(object):
     """ Provides easy handling of extent through various functions below, and abstract out ESRI / WMS differences """
 
+    __slots__ = ('xmin', 'ymin', 'xmax', 'ymax', 'spatial_reference', '_original_format')
+
     def __init__(self, extent=None, spatial_reference=None):
         self.xmin = None
         self.ymin = None
         self.xmax = None
-        self.ymin = None
+        self.ymax = None
         self.spatial_reference = SpatialReference(spatial_reference)
         self._original_format = None
 
@@ -138,7 +143,7 @@ class Extent(object):
         json_dict = self.as_dict()
         for key in ('xmin', 'ymin', 'xmax', 'ymax'):
             json_dict[key] = round(json_dict[key], precision)
-        return json.dumps(json_dict)
+        return json_compat.dumps(json_dict)
 
     def as_sql_poly(self):
         return 'POLYGON(({xmin} {ymin}, {xmax} {ymin}, {xmax} {ymax}, {xmin} {ymax}, {xmin} {ymin}))'.format(
@@ -18,11 +18,12 @@ The Feature Server Layer will have more information provided by the layer specif
 """
 
 import csv
+import datetime
+import hashlib
 import io
-import json
 import logging
-import time
 
+from django.core.cache import cache
 from django.db.utils import DatabaseError
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotFound
@@ -32,9 +33,9 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, View
 from django.conf import settings
 
-from tablo import wkt, LARGE_IMAGE_NAME
+from tablo import json_compat, wkt, LARGE_IMAGE_NAME
 from tablo.geom_utils import Extent
-from tablo.models import FeatureService, FeatureServiceLayer
+from tablo.models import FeatureService, FeatureServiceLayer, get_table_version
 from tablo.storage import default_public_storage as image_storage
 from tablo.utils import json_date_serializer
 
@@ -48,9 +49,14 @@ TEMPORARY_FILE_LOCATION = getattr(settings, 'TABLO_TEMPORARY_FILE_LOCATION', 'te
 
 FILE_STORE_DOMAIN_NAME = getattr(settings, 'FILESTORE_DOMAIN_NAME', 'domain')
 
+# Renderers are cached per classificationDef, and by the current versions of the table data they are generated from
+RENDERER_CACHE_KEY = 'tablo:renderer:{table_name}:{digest}'
+RENDERER_CACHE_TIMEOUT = getattr(settings, 'TABLO_RENDERER_CACHE_TIMEOUT', 300)
+
 
 class FeatureServiceDetailView(DetailView):
     model = FeatureService
+    queryset = FeatureService.objects.prefetch_related('featureservicelayer_set')
     slug_field = 'id'
     slug_url_kwarg = 'service_id'
 
@@ -67,14 +73,15 @@ class FeatureServiceDetailView(DetailView):
             'maxRecordCount': QUERY_LIMIT,
             'description': self.object.description,
             'units': self.object.units,
-            'fullExtent': json.loads(self.object.full_extent),
-            'initialExtent': json.loads(self.object.initial_extent),
-            'spatialReference': json.loads(self.object.spatial_reference),
+            'fullExtent': json_compat.loads(self.object.full_extent),
+            'initialExtent': json_compat.loads(self.object.initial_extent),
+            'spatialReference': json_compat.loads(self.object.spatial_reference),
             'copyrightText': self.object.copyright_text,
             'allowGeometryUpdates': self.object.allow_geometry_updates,
             'layers': []
         }
 
+        # Layers are prefetched, and shared with the extents above
         for layer in self.object.featureservicelayer_set.all():
             data['layers'].append({
                 'id': layer.layer_order,
@@ -83,7 +90,7 @@ class FeatureServiceDetailView(DetailView):
                 'maxScale': 0
             })
 
-        return HttpResponse(json.dumps(data, default=json_date_serializer), content_type='application/json')
+        return HttpResponse(json_compat.dumps(data, default=json_date_serializer), content_type='application/json')
 
 
 class FeatureServiceLayerDetailView(DetailView):
@@ -120,12 +127,12 @@ class FeatureServiceLayerDetailView(DetailView):
             'name': self.object.name,
             'description': self.object.description or '',
             'fields': self.object.fields,
-            'drawingInfo': json.loads(self.object.drawing_info),
+            'drawingInfo': json_compat.loads(self.object.drawing_info),
             'geometryType': self.object.geometry_type,
             'globalIdField': self.object.global_id_field,
             'objectIdField': self.object.object_id_field,
             'displayField': self.object.display_field,
-            'extent': json.loads(self.object.extent),
+            'extent': json_compat.loads(self.object.extent),
             'id': self.object.layer_order
         }
 
@@ -145,7 +152,7 @@ class FeatureServiceLayerDetailView(DetailView):
                 'timeInfo': self.object.time_info
             })
 
-        content = json.dumps(data, default=json_date_serializer)
+        content = json_compat.dumps(data, default=json_date_serializer)
         if self.callback:
             content = '{callback}({data})'.format(callback=self.callback, data=content)
         return HttpResponse(content, content_type='application/json')
@@ -174,7 +181,7 @@ class FeatureLayerView(View):
         layer_index = kwargs.get('layer_index')
 
         self.feature_service_layer = get_object_or_404(
-            FeatureServiceLayer, service__id=service_id, layer_order=layer_index
+            FeatureServiceLayer.objects.select_related('service'), service__id=service_id, layer_order=layer_index
         )
         return super(FeatureLayerView, self).dispatch(request, *args, **kwargs)
 
@@ -251,16 +258,31 @@ class GenerateRendererView(FeatureLayerView):
         try:
             if 'classificationDef' not in kwargs:
                 return HttpResponseBadRequest('Missing classificationDef parameter')
-            classification_def = json.loads(kwargs['classificationDef'])
+            classification_def = json_compat.loads(kwargs['classificationDef'])
+
+            layer = self.feature_service_layer
+            table_names = [layer.table]
+
+            # Unique values of related fields are read from related tables, so their data versions are also used
+            if any('.' in field for field in classification_def.get('uniqueValueFields') or []):
+                table_names.extend(relation.table for relation in layer.relations)
+
+            versions = [get_table_version(table_name) for table_name in table_names]
+            digest = hashlib.sha256(json_compat.dumps_bytes([versions, classification_def], sort_keys=True))
+            cache_key = RENDERER_CACHE_KEY.format(table_name=layer.table, digest=digest.hexdigest())
+            content = cache.get(cache_key)
 
-            if classification_def['type'] == 'uniqueValueDef':
-                renderer = generate_unique_value_renderer(classification_def, self.feature_service_layer)
-            elif classification_def['type'] == 'classBreaksDef':
-                renderer = generate_classified_renderer(classification_def, self.feature_service_layer)
+            if content is None:
+                if classification_def['type'] == 'uniqueValueDef':
+                    renderer = generate_unique_value_renderer(classification_def, layer)
+                elif classification_def['type'] == 'classBreaksDef':
+                    renderer = generate_classified_renderer(classification_def, layer)
+
+                content = json_compat.dumps(renderer, default=json_date_serializer)
+                cache.set(cache_key, content, RENDERER_CACHE_TIMEOUT)
         except (ValueError, KeyError):
-            return HttpResponseBadRequest(json.dumps({'error': 'Invalid request'}))
+            return HttpResponseBadRequest(json_compat.dumps({'error': 'Invalid request'}))
 
-        content = json.dumps(renderer, default=json_date_serializer)
         content_type = 'application/json'
         if self.callback:
             content = '{callback}({data})'.format(callback=self.callback, data=content)
@@ -337,7 +359,7 @@ class TimeQueryView(FeatureLayerView):
             'features': features
         }
 
-        content = json.dumps(response, default=json_date_serializer)
+        content = json_compat.dumps(response, default=json_date_serializer)
         content_type = 'application/json'
         if self.callback:
             content = '{callback}({data})'.format(callback=self.callback, data=content)
@@ -417,8 +439,8 @@ class QueryView(FeatureLayerView):
 
         if 'time' in kwargs and kwargs['time'] != '':
             start_time, end_time = kwargs['time'].split(',')
-            search_params['start_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(float(start_time) / 1000))
-            search_params['end_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(float(end_time) / 1000))
+            search_params['start_time'] = format_query_time(start_time)
+            search_params['end_time'] = format_query_time(end_time)
 
         search_params['out_sr'] = kwargs.get('outSR')
 
@@ -428,11 +450,11 @@ class QueryView(FeatureLayerView):
         geometry_type = kwargs.get('geometryType')
         if geometry_type:
             if geometry_type == 'esriGeometryEnvelope':
-                search_params['extent'] = Extent(json.loads(kwargs['geometry'])).as_sql_poly()
+                search_params['extent'] = Extent(json_compat.loads(kwargs['geometry'])).as_sql_poly()
             elif geometry_type == 'esriGeometryPolygon':
-                search_params['extent'] = convert_esri_polygon_to_wkt(json.loads(kwargs['geometry']))
+                search_params['extent'] = convert_esri_polygon_to_wkt(json_compat.loads(kwargs['geometry']))
             else:
-                return HttpResponseBadRequest(json.dumps({'error': 'Unsupported geometryType'}))
+                return HttpResponseBadRequest(json_compat.dumps({'error': 'Unsupported geometryType'}))
 
         if not return_ids_only and kwargs.get('outFields'):
             return_fields = kwargs['outFields'].split(',') if kwargs.get('outFields') else []
@@ -456,9 +478,9 @@ class QueryView(FeatureLayerView):
             geom_type = self.feature_service_layer.geometry_type
         except ValidationError as e:
             # Failed validation of provided fields and incoming SQL are handled here
-            return HttpResponseBadRequest(json.dumps({'error': e.message}))
+            return HttpResponseBadRequest(json_compat.dumps({'error': e.message}))
         except DatabaseError:
-            return HttpResponseBadRequest(json.dumps({'error': 'Invalid request'}))
+            return HttpResponseBadRequest(json_compat.dumps({'error': 'Invalid request'}))
 
         exceeded_limit = query_response.pop('exceeded_limit')
         query_response = query_response.pop('data')
@@ -483,7 +505,8 @@ class QueryView(FeatureLayerView):
 
                 for item in query_response:
                     if has_geometry and geom_type == 'esriGeometryPoint':
-                        x_loc, y_loc = str(item['st_astext']).replace('POINT(', '').replace(')', '').split(' ')
+                        # Point WKT is always 'POINT(x y)', so the coordinates are sliced out rather than replaced
+                        x_loc, y_loc = str(item['st_astext'])[6:-1].split(' ')
                         item['geometry_x_location'] = x_loc
                         item['geometry_y_location'] = y_loc
                         item.pop('st_astext')
@@ -494,9 +517,8 @@ class QueryView(FeatureLayerView):
                 'exceededTransferLimit': exceeded_limit
             }
             if return_ids_only:
-                object_id_field = self.feature_service_layer.object_id_field
-                data['objectIdFieldName'] = object_id_field
-                data['objectIds'] = [feature[object_id_field] for feature in query_response]
+                data['objectIdFieldName'] = self.feature_service_layer.object_id_field
+                data['objectIds'] = query_response
             else:
                 queried = set(query_response[0].keys()) if query_response else set()
                 features = convert_wkt_to_esri_feature(query_response, self.feature_service_layer)
@@ -504,7 +526,7 @@ class QueryView(FeatureLayerView):
                     'count': len(features),
                     'fields': self.feature_service_layer.fields,
                     'geometryType': geom_type,
-                    'spatialReference': json.loads(self.feature_service_layer.service.spatial_reference),
+                    'spatialReference': json_compat.loads(self.feature_service_layer.service.spatial_reference),
                     'features': features
                 })
 
@@ -517,7 +539,7 @@ class QueryView(FeatureLayerView):
             content = data.getvalue()
             content_type = 'text/csv'
         else:
-            content = json.dumps(data, default=json_date_serializer)
+            content = json_compat.dumps(data, default=json_date_serializer)
 
             if not self.callback:
                 content_type = 'application/json'
@@ -555,14 +577,9 @@ def generate_classified_renderer(classification_def, layer):
     elif method == 'esriClassifyNaturalBreaks':
         breaks = layer.get_natural_breaks(field, break_count)
 
-    class_break_infos = []
-    current_min = breaks[0]
-    for break_info in breaks[1:]:
-        class_break_infos.append({
-            'classMinValue': current_min,
-            'classMaxValue': break_info
-        })
-        current_min = break_info
+    class_break_infos = [
+        {'classMinValue': class_min, 'classMaxValue': class_max} for class_min, class_max in zip(breaks, breaks[1:])
+    ]
 
     return {
         'type': 'classBreaks',
@@ -573,6 +590,12 @@ def generate_classified_renderer(classification_def, layer):
     }
 
 
+def format_query_time(timestamp):
+    """ Converts an ArcGIS time, in milliseconds since the epoch, to the UTC timestamp used in queries """
+    utc_time = datetime.datetime.fromtimestamp(float(timestamp) / 1000, datetime.timezone.utc)
+    return utc_time.replace(tzinfo=None).isoformat(' ', 'seconds')
+
+
 def convert_esri_polygon_to_wkt(polygon_json):
     polygon_string = 'MULTIPOLYGON(('
     for ring in polygon_json['rings']:
@@ -678,7 +701,7 @@ class ImageView(FeatureLayerView):
         entry_id = kwargs.get('entry_id')
         col_name = kwargs.get('col_name')
 
-        service_id = self.feature_service_layer.service.id
+        service_id = self.feature_service_layer.service_id
 
         # Read from s3
         s3_path = '{domain}/{service_id}/{entry_id}/{col_name}/{image_name}'.format(
@@ -0,0 +1,23 @@
+import orjson
+
+
+def loads(s):
+    """ :return: the object decoded from a JSON string or bytes """
+    return orjson.loads(s)
+
+
+def dumps(obj, default=None, sort_keys=False):
+    """ :return: the object encoded as a JSON string, rather than the bytes returned by orjson """
+    return dumps_bytes(obj, default, sort_keys).decode()
+
+
+def dumps_bytes(obj, default=None, sort_keys=False, passthrough_datetime=False):
+    """
+    :param passthrough_datetime: if True, dates and times are passed to ``default`` rather than written as ISO 8601
+    :return: the object encoded as JSON bytes, for responses that are written out without decoding
+    """
+
+    option = orjson.OPT_SORT_KEYS if sort_keys else 0
+    if passthrough_datetime:
+        option |= orjson.OPT_PASSTHROUGH_DATETIME
+    return orjson.dumps(obj, default=default, option=option)
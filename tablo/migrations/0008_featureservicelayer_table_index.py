@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tablo', '0007_update_integer_columns_to_bigint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='featureservicelayer',
+            name='table',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
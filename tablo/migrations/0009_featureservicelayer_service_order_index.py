@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently, which cannot be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('tablo', '0008_featureservicelayer_table_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='featureservicelayer',
+                    index=models.Index(fields=['service', 'layer_order'], name='tablo_layer_service_order_idx'),
+                ),
+            ],
+            database_operations=[
+                # Avoid locking the layer table against writes while the index is built on a live database
+                migrations.RunSQL(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS tablo_layer_service_order_idx '
+                    'ON tablo_featureservicelayer (service_id, layer_order)',
+                    'DROP INDEX CONCURRENTLY IF EXISTS tablo_layer_service_order_idx'
+                ),
+            ]
+        ),
+    ]
@@ -1,30 +1,31 @@
 import base64
 import calendar
-import json
 import logging
-import re
 import sqlparse
 import uuid
 
 from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 from io import BytesIO
 
 from django.conf import settings
-from django.db import models, DatabaseError, connection
+from django.core.cache import cache
+from django.db import models, transaction, DatabaseError, connection
 from django.db.models import signals
 from django.utils.datastructures import OrderedSet
 
 import pandas as pd
-from geoalchemy2 import Geometry
 from PIL import Image, ImageOps
+from psycopg2.extras import execute_values
 from sqlparse.tokens import Token
 
-from . import wkt, LARGE_IMAGE_NAME, NO_PK, PANDAS_TYPE_CONVERSION, POSTGIS_ESRI_FIELD_MAPPING, IMPORT_SUFFIX
-from . import TABLE_NAME_PREFIX, PRIMARY_KEY_NAME, GEOM_FIELD_NAME, SOURCE_DATASET_FIELD_NAME, WEB_MERCATOR_SRID
-from . import ADJUSTED_GLOBAL_EXTENT
-from .csv_utils import prepare_row_set_for_import, convert_header_to_column_name
-from .exceptions import InvalidFieldsError, InvalidSQLError, RelatedFieldsError
+from . import json_compat, wkt, LARGE_IMAGE_NAME, NO_PK, PANDAS_TYPE_CONVERSION, POSTGIS_ESRI_FIELD_MAPPING
+from . import IMPORT_SUFFIX, TABLE_NAME_PREFIX, PRIMARY_KEY_NAME, GEOM_FIELD_NAME, SOURCE_DATASET_FIELD_NAME
+from . import ADJUSTED_GLOBAL_EXTENT, WEB_MERCATOR_SRID
+from .csv_utils import CSVRowStream, convert_header_to_column_name, infer_csv_schema, iter_csv_rows
+from .csv_utils import detect_csv_date_formats, iso_date_converter, prepare_row_set_for_import
+from .exceptions import InvalidFieldsError, InvalidFileError, InvalidSQLError, RelatedFieldsError
 from .geom_utils import Extent, SpatialReference
 from .storage import default_public_storage as image_storage
 from .utils import get_jenks_breaks, get_sqlalchemy_engine, dictfetchall
@@ -33,6 +34,39 @@ from .utils import get_jenks_breaks, get_sqlalchemy_engine, dictfetchall
 TEMPORARY_FILE_LOCATION = getattr(settings, 'TABLO_TEMPORARY_FILE_LOCATION', 'temp')
 FILE_STORE_DOMAIN_NAME = getattr(settings, 'FILESTORE_DOMAIN_NAME', 'domain')
 
+# Table fields are cached across requests, and invalidated wherever this module changes a table's columns
+FIELDS_CACHE_KEY = 'tablo:fields:{table_name}'
+FIELDS_CACHE_TIMEOUT = getattr(settings, 'TABLO_FIELDS_CACHE_TIMEOUT', 300)
+
+# Results derived from a table's data are cached under its current version, which is replaced when the data changes
+TABLE_VERSION_CACHE_KEY = 'tablo:table_version:{table_name}'
+
+# Maximum number of rows sent per statement for bulk feature edits
+BULK_PAGE_SIZE = 1000
+
+# Number of bytes read from a CSV stream for each message sent with COPY, rather than the psycopg2 default of 8 KB
+COPY_BUFFER_SIZE = 2 ** 16
+
+# Column types for CSV data types and additional field types, used when streaming a CSV into an import table
+IMPORT_COLUMN_TYPES = {
+    'date': 'timestamp without time zone',
+    'decimal': 'double precision',
+    'double': 'double precision',
+    'dropdown': 'text',
+    'dropdownedit': 'text',
+    'empty': 'text',
+    'image': 'text',
+    'integer': 'bigint',
+    'string': 'text',
+    'text': 'text',
+    'timestamp': 'timestamp without time zone',
+    'xlocation': 'double precision',
+    'ylocation': 'double precision'
+}
+
+# Layer fields that cached extents are computed from: the time extent depends on all of them, the extent on the table
+EXTENT_SOURCE_FIELDS = ('table', 'start_time_field', 'supports_time')
+
 logger = logging.getLogger(__name__)
 
 
@@ -49,15 +83,15 @@ class FeatureService(models.Model):
     @property
     def initial_extent(self):
         if self._initial_extent is None and self.featureservicelayer_set.all():
-            self._initial_extent = json.dumps(determine_extent(self.featureservicelayer_set.all()[0].table))
-            self.save()
+            self._initial_extent = json_compat.dumps(determine_extent(self.featureservicelayer_set.all()[0].table))
+            self.save(update_fields=['_initial_extent'])
         return self._initial_extent
 
     @property
     def full_extent(self):
         if self._full_extent is None and self.featureservicelayer_set.all():
-            self._full_extent = json.dumps(determine_extent(self.featureservicelayer_set.all()[0].table))
-            self.save()
+            self._full_extent = json_compat.dumps(determine_extent(self.featureservicelayer_set.all()[0].table))
+            self.save(update_fields=['_full_extent'])
         return self._full_extent
 
     @property
@@ -71,7 +105,15 @@ class FeatureService(models.Model):
         # Renames the table associated with the feature service to remove the IMPORT tag
         fs_layer = self.featureservicelayer_set.first()
         fs_layer.table = TABLE_NAME_PREFIX + dataset_id
-        fs_layer.save()
+
+        # Cached extents may have been carried over from a copied service before its data was appended to
+        fs_layer._extent = None
+        fs_layer._time_extent = None
+        fs_layer.save(update_fields=['table', '_extent', '_time_extent'])
+
+        self._initial_extent = None
+        self._full_extent = None
+        self.save(update_fields=['_initial_extent', '_full_extent'])
 
         old_table_name = TABLE_NAME_PREFIX + dataset_id + IMPORT_SUFFIX
         new_table_name = TABLE_NAME_PREFIX + dataset_id
@@ -110,12 +152,14 @@ class FeatureService(models.Model):
                     )
                 )
 
+        invalidate_fields(old_table_name, new_table_name)
+
 
 class FeatureServiceLayer(models.Model):
     id = models.AutoField(auto_created=True, primary_key=True)
     service = models.ForeignKey(FeatureService, on_delete=models.CASCADE)
     layer_order = models.IntegerField()
-    table = models.CharField(max_length=255)
+    table = models.CharField(max_length=255, db_index=True)
     name = models.CharField(max_length=255, null=True)
     description = models.TextField(null=True)
     object_id_field = models.CharField(max_length=255, default=PRIMARY_KEY_NAME)
@@ -130,22 +174,67 @@ class FeatureServiceLayer(models.Model):
     time_interval_units = models.CharField(max_length=255, null=True)
     drawing_info = models.TextField()
 
+    class Meta:
+        indexes = [
+            # Layers are looked up by service and ordered by layer_order throughout the API
+            models.Index(fields=['service', 'layer_order'], name='tablo_layer_service_order_idx'),
+        ]
+
     _fields = None
     _related_fields = None
     _relations = None
     _srid = None
+    _loaded_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(FeatureServiceLayer, cls).from_db(db, field_names, values)
+
+        # The stored values the extents are computed from are kept, so that save can tell when they no longer apply
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if name in EXTENT_SOURCE_FIELDS
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        """ Overridden to clear cached extents when the table or time field they were computed from changes """
+
+        loaded_values = self._loaded_values or {}
+        changed = {name for name, value in loaded_values.items() if getattr(self, name) != value}
+
+        cleared = []
+        if 'table' in changed:
+            self._extent = None
+            cleared.append('_extent')
+        if changed:
+            self._time_extent = None
+            cleared.append('_time_extent')
+
+        update_fields = kwargs.get('update_fields')
+        if cleared and update_fields is not None:
+            kwargs['update_fields'] = set(update_fields).union(cleared)
+
+        super(FeatureServiceLayer, self).save(*args, **kwargs)
+
+        for name in loaded_values:
+            loaded_values[name] = getattr(self, name)
+
+    def set_loaded_values(self):
+        """ Records the table and time fields as stored, for layers saved without ``save``, as by ``bulk_create`` """
+
+        self._loaded_values = {name: getattr(self, name) for name in EXTENT_SOURCE_FIELDS}
 
     @property
     def extent(self):
         if self._extent is None:
-            self._extent = json.dumps(determine_extent(self.table))
-            self.save()
+            self._extent = json_compat.dumps(determine_extent(self.table))
+            self.save(update_fields=['_extent'])
         return self._extent
 
     @property
     def srid(self):
         if not self._srid:
-            self._srid = json.loads(self.service.spatial_reference)['wkid']
+            self._srid = json_compat.loads(self.service.spatial_reference)['wkid']
         return self._srid
 
     @property
@@ -153,35 +242,59 @@ class FeatureServiceLayer(models.Model):
         if not self.supports_time:
             return '[]'
 
-        # TODO: Remove fields from database if we really don't want to continue using them
-        return json.dumps(self.get_raw_time_extent())
+        if self._time_extent is None:
+            self._time_extent = json_compat.dumps(self.get_raw_time_extent())
+            self.save(update_fields=['_time_extent'])
+        return self._time_extent
+
+    def get_raw_time_extent(self, primary_keys=None):
+        """
+        :param primary_keys: if given, only the extent of these features is read, through the index on the primary
+            key column, rather than that of the whole table. Either end is None if none of the features have a time.
+        """
 
-    def get_raw_time_extent(self):
         query = 'SELECT MIN({date_field}), MAX({date_field}) FROM {table_name}'.format(
             date_field=self.start_time_field,
             table_name=self.table
         )
+        params = []
+        if primary_keys is not None:
+            query += ' WHERE {pk} = ANY(%s::bigint[])'.format(pk=PRIMARY_KEY_NAME)
+            params.append(list(primary_keys))
 
         with connection.cursor() as c:
-            c.execute(query)
-            min_date, max_date = (calendar.timegm(x.timetuple()) * 1000 for x in c.fetchone())
+            c.execute(query, params)
+            min_date, max_date = (
+                None if x is None else calendar.timegm(x.timetuple()) * 1000 for x in c.fetchone()
+            )
 
         return [min_date, max_date]
 
     @property
     def fields(self):
         if self._fields is None:
-            fields = get_fields(self.table)
+            self._set_fields(get_fields(self.table))
+        return self._fields
 
-            for field in fields:
-                if field['name'] == 'db_id':
-                    field['type'] = 'esriFieldTypeOID'
-                elif field['name'] == GEOM_FIELD_NAME:
-                    field['type'] = 'esriFieldTypeGeometry'
+    def _set_fields(self, fields):
+        for field in fields:
+            if field['name'] == 'db_id':
+                field['type'] = 'esriFieldTypeOID'
+            elif field['name'] == GEOM_FIELD_NAME:
+                field['type'] = 'esriFieldTypeGeometry'
 
-            self._fields = fields
+        self._fields = fields
 
-        return self._fields
+    @staticmethod
+    def prefetch_fields(layers):
+        """ Loads the fields of many layers at once, rather than with a cache lookup and query for each layer """
+
+        layers = [layer for layer in layers if layer._fields is None]
+        fields_by_table = get_fields_for_tables({layer.table for layer in layers})
+
+        for layer in layers:
+            # Each layer gets its own copies, since the fields are annotated in place
+            layer._set_fields([dict(field) for field in fields_by_table[layer.table]])
 
     @property
     def relations(self):
@@ -205,7 +318,7 @@ class FeatureServiceLayer(models.Model):
         if self.start_time_field:
             return {
                 'startTimeField': self.start_time_field,
-                'timeExtent': json.loads(self.time_extent),
+                'timeExtent': json_compat.loads(self.time_extent),
                 'timeInterval': int(self.time_interval),
                 'timeIntervalUnits': self.time_interval_units
             }
@@ -225,14 +338,14 @@ class FeatureServiceLayer(models.Model):
 
         # Break out fields and DESC / ASC modifiers
         order_by_field_objs = []
-        for field in [f.strip() for f in kwargs.get('order_by_fields') or '']:
-            m = re.match('(\S*)\s?(asc|desc)?', field, re.IGNORECASE)
-            field_obj = {'field_name': m.group(1)}
-            try:
-                field_obj['order_modifier'] = m.group(2)
-            except IndexError:
-                pass  # No modifier
-            order_by_field_objs.append(field_obj)
+        for field in kwargs.get('order_by_fields') or '':
+            field_name, _, modifier = field.strip().partition(' ')
+            modifier = modifier.strip()
+            # The modifier is added to the ORDER BY clause as is, so anything but ASC or DESC is dropped
+            order_by_field_objs.append({
+                'field_name': field_name,
+                'order_modifier': modifier if modifier.lower() in ('asc', 'desc') else None
+            })
 
         order_by_field_names = [f['field_name'] for f in order_by_field_objs]
 
@@ -280,7 +393,9 @@ class FeatureServiceLayer(models.Model):
 
         with connection.cursor() as c:
             c.execute(query_clause, query_params)
-            queried_data = dictfetchall(c)
+
+            # Only the ids are returned when they are all that was queried, rather than a dict for every row
+            queried_data = [row[0] for row in c.fetchall()] if ids_only else dictfetchall(c)
 
         limited_data = 0 < limit < len(queried_data)
         queried_data = queried_data[:-1] if limited_data else queried_data
@@ -634,52 +749,316 @@ class FeatureServiceLayer(models.Model):
 
         return get_jenks_breaks(values, break_count)
 
-    def add_feature(self, feature):
+    def add_feature(self, feature, colnames_in_table=None, date_fields=None, image_fields=None):
+        """
+        Inserts a single feature. Columns and fields already resolved for the table may be passed in, so that
+        they are not looked up again for every feature of a batch.
+        """
+
+        if colnames_in_table is None:
+            colnames_in_table = self._get_column_names(exclude={PRIMARY_KEY_NAME, GEOM_FIELD_NAME})
+        values, images_large = self._prepare_feature_for_insert(feature, colnames_in_table, date_fields, image_fields)
+
+        # The geometry is inserted with the attributes, rather than set by a second UPDATE of the new row
+        values.append(wkt.from_esri_feature(feature['geometry'], self.geometry_type))
+        placeholders = ['%s'] * len(colnames_in_table)
+        placeholders.append('ST_Transform(ST_GeomFromEWKT(%s), {table_srid})'.format(table_srid=self.srid))
+
+        insert_command = 'INSERT INTO {table_name} ({attribute_names}) VALUES ({placeholders}) RETURNING {pk}'.format(
+            table_name=self.table,
+            attribute_names=','.join(colnames_in_table + [GEOM_FIELD_NAME]),
+            placeholders=','.join(placeholders),
+            pk=PRIMARY_KEY_NAME
+        )
 
-        system_cols = {PRIMARY_KEY_NAME, GEOM_FIELD_NAME}
         with connection.cursor() as c:
-            c.execute('SELECT * from {dataset_table_name} LIMIT 0'.format(
-                dataset_table_name=self.table
-            ))
-            colnames_in_table = [desc[0].lower() for desc in c.description if desc[0] not in system_cols]
+            c.execute(insert_command, values)
+            primary_key = c.fetchone()[0]
 
-        columns_not_present = colnames_in_table[0:]
+        for key, value in images_large.items():
+            image_path = key.replace(NO_PK, str(primary_key))
+            FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
 
-        columns_in_request = feature['attributes'].copy()
-        for field in system_cols:
-            if field in columns_in_request:
-                columns_in_request.pop(field)
+        return primary_key
 
-        for key in columns_in_request:
-            if key not in colnames_in_table:
-                raise AttributeError('attributes do not match')
-            columns_not_present.remove(key)
+    def bulk_add_features(self, features):
+        """
+        Inserts all valid features with a single multi-row INSERT, falling back to per-feature inserts if it fails.
+        :return: a list with either the new primary key or the error raised, for each of the features in order
+        """
 
-        if len(columns_not_present):
-            raise AttributeError('Missing attributes {0}'.format(','.join(columns_not_present)))
+        if not features:
+            return []
+
+        colnames_in_table = self._get_column_names(exclude={PRIMARY_KEY_NAME, GEOM_FIELD_NAME})
+        date_fields, image_fields = self._get_date_and_image_fields()
+
+        results = [None] * len(features)
+        rows = []
+        row_indexes = []
+        row_images = []
+
+        for idx, feature in enumerate(features):
+            try:
+                values, images_large = self._prepare_feature_for_insert(
+                    feature, colnames_in_table, date_fields, image_fields
+                )
+                values.append(wkt.from_esri_feature(feature['geometry'], self.geometry_type))
+            except Exception as e:
+                results[idx] = e
+                continue
+
+            rows.append(values)
+            row_indexes.append(idx)
+            row_images.append(images_large)
+
+        if not rows:
+            return results
+
+        insert_command = 'INSERT INTO {table_name} ({attribute_names}) VALUES %s RETURNING {pk}'.format(
+            table_name=self.table,
+            attribute_names=','.join(colnames_in_table + [GEOM_FIELD_NAME]),
+            pk=PRIMARY_KEY_NAME
+        )
+        placeholders = ['%s'] * len(colnames_in_table)
+        placeholders.append('ST_Transform(ST_GeomFromEWKT(%s), {table_srid})'.format(table_srid=self.srid))
+
+        try:
+            with transaction.atomic(), connection.cursor() as c, connection.wrap_database_errors:
+                inserted = execute_values(
+                    c.cursor, insert_command, rows,
+                    template='({0})'.format(','.join(placeholders)), page_size=BULK_PAGE_SIZE, fetch=True
+                )
+        except DatabaseError:
+            logger.warning('Bulk insert into {0} failed, inserting features individually'.format(self.table))
+            add_feature = partial(
+                self.add_feature,
+                colnames_in_table=colnames_in_table, date_fields=date_fields, image_fields=image_fields
+            )
+            inserted_results = self._apply_per_feature(add_feature, [features[idx] for idx in row_indexes])
+            for idx, result in zip(row_indexes, inserted_results):
+                results[idx] = result
+            return results
+
+        for idx, (primary_key,), images_large in zip(row_indexes, inserted, row_images):
+            results[idx] = primary_key
+
+            for key, value in images_large.items():
+                image_path = key.replace(NO_PK, str(primary_key))
+                FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
+
+        return results
 
-        insert_command = (
-            'INSERT INTO {table_name} ({attribute_names}) VALUES ({placeholders}) RETURNING {pk}'.format(
+    def update_feature(self, feature, colnames_in_table=None, date_fields=None, image_fields=None):
+        """ Updates a single feature. As with ``add_feature``, resolved columns and fields may be passed in. """
+
+        if colnames_in_table is None:
+            colnames_in_table = self._get_column_names()
+        primary_key, updates, images_large = self._prepare_feature_for_update(
+            feature, colnames_in_table, date_fields, image_fields
+        )
+
+        # Attributes and geometry are set by the same statement
+        set_portion = ['{0} = %s'.format(key) for key in updates]
+        params = list(updates.values())
+
+        if feature.get('geometry'):
+            set_portion.append('{0} = ST_Transform(ST_GeomFromEWKT(%s), {1})'.format(GEOM_FIELD_NAME, self.srid))
+            params.append(wkt.from_esri_feature(feature['geometry'], self.geometry_type))
+
+        update_command = 'UPDATE {table_name} SET {set_portion} WHERE {pk}=%s'.format(
+            table_name=self.table,
+            set_portion=','.join(set_portion),
+            pk=PRIMARY_KEY_NAME
+        )
+
+        with connection.cursor() as c:
+            c.execute(update_command, params + [primary_key])
+
+        # Save out large images
+        for image_path, value in images_large.items():
+            FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
+
+        return primary_key
+
+    def bulk_update_features(self, features):
+        """
+        Updates features sharing the same attributes with a single UPDATE ... FROM (VALUES ...) statement per group,
+        falling back to per-feature updates for any group that fails.
+        :return: a list with either the primary key or the error raised, for each of the features in order
+        """
+
+        if not features:
+            return []
+
+        column_types = self._get_column_types()
+        colnames_in_table = list(column_types)
+        date_fields, image_fields = self._get_date_and_image_fields()
+
+        results = [None] * len(features)
+        groups = OrderedDict()
+
+        for idx, feature in enumerate(features):
+            try:
+                primary_key, updates, images_large = self._prepare_feature_for_update(
+                    feature, colnames_in_table, date_fields, image_fields
+                )
+                row = [primary_key] + list(updates.values())
+                if feature.get('geometry'):
+                    row.append(wkt.from_esri_feature(feature['geometry'], self.geometry_type))
+            except Exception as e:
+                results[idx] = e
+                continue
+
+            group = groups.setdefault((tuple(updates), bool(feature.get('geometry'))), [])
+            group.append((idx, row, images_large))
+
+        for (columns, has_geometry), group in groups.items():
+            value_columns = [PRIMARY_KEY_NAME] + list(columns)
+            set_portion = ['{0} = v.{0}'.format(column) for column in columns]
+            template = ['%s::{0}'.format(column_types[column]) for column in value_columns]
+
+            if has_geometry:
+                value_columns.append(GEOM_FIELD_NAME)
+                set_portion.append('{0} = ST_Transform(ST_GeomFromEWKT(v.{0}), {1})'.format(
+                    GEOM_FIELD_NAME, self.srid
+                ))
+                template.append('%s::text')
+
+            update_command = (
+                'UPDATE {table_name} AS t SET {set_portion} '
+                'FROM (VALUES %s) AS v ({value_columns}) WHERE t.{pk} = v.{pk}'
+            ).format(
                 table_name=self.table,
-                attribute_names=','.join(colnames_in_table),
-                placeholders=','.join(['%s'] * len(colnames_in_table)),
+                set_portion=','.join(set_portion),
+                value_columns=','.join(value_columns),
                 pk=PRIMARY_KEY_NAME
             )
-        )
 
-        transform_op = 'ST_Transform(ST_GeomFromEWKT(\'{geom}\'), {table_srid})'.format(
-            geom=wkt.from_esri_feature(feature['geometry'], self.geometry_type),
-            table_srid=self.srid
+            try:
+                with transaction.atomic(), connection.cursor() as c, connection.wrap_database_errors:
+                    execute_values(
+                        c.cursor, update_command, [row for _, row, _ in group],
+                        template='({0})'.format(','.join(template)), page_size=BULK_PAGE_SIZE
+                    )
+            except DatabaseError:
+                logger.warning('Bulk update of {0} failed, updating features individually'.format(self.table))
+                update_feature = partial(
+                    self.update_feature,
+                    colnames_in_table=colnames_in_table, date_fields=date_fields, image_fields=image_fields
+                )
+                updated_results = self._apply_per_feature(update_feature, [features[idx] for idx, _, _ in group])
+                for (idx, _, _), result in zip(group, updated_results):
+                    results[idx] = result
+                continue
+
+            for idx, row, images_large in group:
+                results[idx] = row[0]
+
+                for image_path, value in images_large.items():
+                    FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
+
+        return results
+
+    def delete_feature(self, primary_key):
+
+        delete_command = 'DELETE FROM {table_name} WHERE {pk}=%s'.format(
+            table_name=self.table,
+            pk=PRIMARY_KEY_NAME
         )
-        set_geom_command = 'UPDATE {table_name} SET {geom_column} = {transform_op} WHERE {pk}=%s'.format(
+
+        with connection.cursor() as c:
+            c.execute(delete_command, [primary_key])
+
+        self._delete_feature_images(primary_key)
+
+        return primary_key
+
+    def bulk_delete_features(self, primary_keys):
+        """
+        Deletes all features with a single DELETE statement, falling back to per-feature deletes if it fails.
+        :return: a list with either the primary key or the error raised, for each of the primary keys in order
+        """
+
+        if not primary_keys:
+            return []
+
+        # The primary keys are sent as one array parameter, rather than a placeholder for each
+        delete_command = 'DELETE FROM {table_name} WHERE {pk} = ANY(%s::bigint[])'.format(
             table_name=self.table,
-            geom_column=GEOM_FIELD_NAME,
-            transform_op=transform_op,
             pk=PRIMARY_KEY_NAME
         )
 
+        try:
+            with transaction.atomic(), connection.cursor() as c:
+                c.execute(delete_command, [list(primary_keys)])
+        except DatabaseError:
+            logger.warning('Bulk delete from {0} failed, deleting features individually'.format(self.table))
+            return self._apply_per_feature(self.delete_feature, primary_keys)
+
+        image_fields = self._get_date_and_image_fields()[1]
+        for primary_key in primary_keys:
+            self._delete_feature_images(primary_key, image_fields)
+
+        return list(primary_keys)
+
+    def _apply_per_feature(self, edit_func, items):
+        """ Applies an edit to each item in its own savepoint, so that one failure does not abort the others """
+
+        results = []
+        for item in items:
+            try:
+                with transaction.atomic():
+                    results.append(edit_func(item))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _get_column_names(self, exclude=()):
+        # Fields are cached, and invalidated whenever columns change, so the table itself is not queried
+        return [field['name'].lower() for field in self.fields if field['name'] not in exclude]
+
+    def _get_column_types(self):
+        """ :return: an ordered mapping of column names to their full database types, as used for casting """
+
+        with connection.cursor() as c:
+            c.execute(
+                ' '.join((
+                    'SELECT attname, format_type(atttypid, atttypmod)',
+                    'FROM pg_attribute',
+                    'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped',
+                    'ORDER BY attnum'
+                )),
+                [self.table]
+            )
+            return OrderedDict((name.lower(), data_type) for name, data_type in c.fetchall())
+
+    def _get_date_and_image_fields(self):
         date_fields = [field['name'] for field in self.fields if field['type'] == 'esriFieldTypeDate']
         image_fields = [field['name'] for field in self.fields if field['type'] == 'esriFieldTypeBlob']
+        return date_fields, image_fields
+
+    def _prepare_feature_for_insert(self, feature, colnames_in_table, date_fields=None, image_fields=None):
+        """ Validates feature attributes against the table, and returns insert values along with any large images """
+
+        if date_fields is None or image_fields is None:
+            date_fields, image_fields = self._get_date_and_image_fields()
+
+        system_cols = {PRIMARY_KEY_NAME, GEOM_FIELD_NAME}
+        columns_not_present = colnames_in_table[0:]
+
+        columns_in_request = feature['attributes'].copy()
+        for field in system_cols:
+            if field in columns_in_request:
+                columns_in_request.pop(field)
+
+        for key in columns_in_request:
+            if key not in colnames_in_table:
+                raise AttributeError('attributes do not match')
+            columns_not_present.remove(key)
+
+        if len(columns_not_present):
+            raise AttributeError('Missing attributes {0}'.format(','.join(columns_not_present)))
 
         # Creating a dictionary where the key is the Amazon S3 path and the value is the Image for the field
 
@@ -704,39 +1083,24 @@ class FeatureServiceLayer(models.Model):
             else:
                 values.append(feature['attributes'][attribute_name])
 
-        with connection.cursor() as c:
-            c.execute(insert_command, values)
-            primary_key = c.fetchone()[0]
-            c.execute(set_geom_command, [primary_key])
-
-        for key, value in images_large.items():
-            image_path = key.replace(NO_PK, str(primary_key))
-            FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
-
-        return primary_key
-
-    def update_feature(self, feature):
+        return values, images_large
 
-        with connection.cursor() as c:
-            c.execute('SELECT * from {dataset_table_name} LIMIT 0'.format(
-                dataset_table_name=self.table
-            ))
-            colnames_in_table = [desc[0].lower() for desc in c.description]
+    def _prepare_feature_for_update(self, feature, colnames_in_table, date_fields=None, image_fields=None):
+        """ Validates feature attributes against the table, and returns the primary key, updates and large images """
 
         if PRIMARY_KEY_NAME not in feature['attributes']:
             raise AttributeError('Cannot update feature without a primary key')
 
-        primary_key = feature['attributes'][PRIMARY_KEY_NAME]
+        if date_fields is None or image_fields is None:
+            date_fields, image_fields = self._get_date_and_image_fields()
 
-        date_fields = [field['name'] for field in self.fields if field['type'] == 'esriFieldTypeDate']
-        image_fields = [field['name'] for field in self.fields if field['type'] == 'esriFieldTypeBlob']
+        primary_key = feature['attributes'][PRIMARY_KEY_NAME]
 
         # Creating a dictionary where the key is the Amazon S3 path and the value is the Image for the field
 
         images_large = {}
         images_thumbs = {}
-        argument_updates = []
-        argument_values = []
+        updates = OrderedDict()
 
         for key in feature['attributes']:
             if key == PRIMARY_KEY_NAME:
@@ -744,78 +1108,43 @@ class FeatureServiceLayer(models.Model):
             if key not in colnames_in_table:
                 raise AttributeError('attributes do not match')
             if key != GEOM_FIELD_NAME:
-                argument_updates.append('{0} = %s'.format(key))
                 if key in date_fields and feature['attributes'][key]:
                     if isinstance(feature['attributes'][key], str):
-                        argument_values.append(feature['attributes'][key])
+                        updates[key] = feature['attributes'][key]
                     else:
-                        argument_values.append(datetime.fromtimestamp(feature['attributes'][key] / 1000))
+                        updates[key] = datetime.fromtimestamp(feature['attributes'][key] / 1000)
                 elif key in image_fields and feature['attributes'][key]:
                     image_path = FeatureServiceLayer.create_image_path(self.service.id, primary_key, key)
-                    img_base64_data = FeatureServiceLayer.process_image_data(
+                    updates[key] = FeatureServiceLayer.process_image_data(
                         feature['attributes'][key], image_path, images_large, images_thumbs
                     )
-                    argument_values.append(img_base64_data)
                 else:
-                    argument_values.append(feature['attributes'][key])
-
-        argument_values.append(feature['attributes'][PRIMARY_KEY_NAME])
-
-        update_command = 'UPDATE {table_name} SET {set_portion} WHERE {pk}=%s'.format(
-            table_name=self.table,
-            set_portion=','.join(argument_updates),
-            pk=PRIMARY_KEY_NAME
-        )
-
-        with connection.cursor() as c:
-            c.execute(update_command, argument_values)
-
-            if feature.get('geometry'):
-                transform_op = 'ST_Transform(ST_GeomFromEWKT(\'{geom}\'), {table_srid})'.format(
-                    geom=wkt.from_esri_feature(feature['geometry'], self.geometry_type),
-                    table_srid=self.srid
-                )
-                set_geom_command = 'UPDATE {table_name} SET {geom_column} = {transform_op} WHERE {pk}=%s'.format(
-                    table_name=self.table,
-                    geom_column=GEOM_FIELD_NAME,
-                    transform_op=transform_op,
-                    pk=PRIMARY_KEY_NAME
-                )
-                c.execute(set_geom_command, [primary_key])
-
-        # Save out large images
-        for key, value in images_large.items():
-            FeatureServiceLayer.save_image(value, image_path, LARGE_IMAGE_NAME)
+                    updates[key] = feature['attributes'][key]
 
-        return primary_key
+        if not updates and not feature.get('geometry'):
+            raise AttributeError('No attributes or geometry to update')
 
-    def delete_feature(self, primary_key):
+        return primary_key, updates, images_large
 
-        delete_command = 'DELETE FROM {table_name} WHERE {pk}=%s'.format(
-            table_name=self.table,
-            pk=PRIMARY_KEY_NAME
-        )
+    def _delete_feature_images(self, primary_key, image_fields=None):
 
-        with connection.cursor() as c:
-            c.execute(delete_command, [primary_key])
-
-        image_fields = [field['name'] for field in self.fields if field['type'] == 'esriFieldTypeBlob']
+        if image_fields is None:
+            image_fields = self._get_date_and_image_fields()[1]
 
         # Delete image from S3 storage
         for col_name in image_fields:
 
             try:
                 s3_path = '{0}/{1}'.format(
-                    FeatureServiceLayer.create_image_path(self.service.id, primary_key, col_name),
+                    FeatureServiceLayer.create_image_path(self.service_id, primary_key, col_name),
                     LARGE_IMAGE_NAME
                 )
-                if image_storage.exists(s3_path):
-                    image_storage.delete(s3_path)
+                # Deleting a missing key succeeds in S3, so there is no need for a separate request to check
+                image_storage.delete(s3_path)
 
             except Exception as e:
-                logger.exception(e)
-
-        return primary_key
+                # Called for every deleted feature: a storage outage should not log a traceback for each one
+                logger.error('Error deleting image {0}: {1}'.format(s3_path, e))
 
     @staticmethod
     def create_image_path(service_id, row_id, field_name):
@@ -866,7 +1195,8 @@ class FeatureServiceLayer(models.Model):
                 img.close()
 
         except Exception as e:
-            logger.exception(e)
+            # Called for every added or updated feature with an image, so no traceback is logged
+            logger.error('Error saving image {0}: {1}'.format(s3_path, e))
 
 
 class FeatureServiceLayerRelations(models.Model):
@@ -917,6 +1247,8 @@ def delete_data_table(sender, instance, **kwargs):
     with connection.cursor() as c:
         c.execute('DROP table IF EXISTS {table_name}'.format(table_name=instance.table))
 
+    invalidate_fields(instance.table)
+
 
 signals.pre_delete.connect(delete_data_table, sender=FeatureServiceLayer)
 
@@ -1000,6 +1332,8 @@ def copy_data_table_for_import(dataset_id):
         c.execute(alter_sequence_command)
         c.execute(alter_sequence_start_command)
 
+    invalidate_fields(import_table_name)
+
     return TABLE_NAME_PREFIX + dataset_id + IMPORT_SUFFIX
 
 
@@ -1012,71 +1346,80 @@ def sequence_exists(sequence_name):
 class Column(object):
     """ Helper for table creation """
 
-    def __init__(self, **entries):
-        self.__dict__.update(entries)
+    __slots__ = ('column', 'type', 'required')
+
+    def __init__(self, column, type, required=True):
+        self.column = column
+        self.type = type
+        self.required = required
 
 
 def create_aggregate_database_table(row, dataset_id):
-    # TODO optimize the aggregate pipeline
-    # SEE:https://github.com/consbio/tablo/pull/35 for the discussion on temp tables
-    #     and whether `append` is needed with `create_database_table`
-    columns = [convert_header_to_column_name(SOURCE_DATASET_FIELD_NAME)]
-    data_types = ['String']
-    optional_fields = []
-    type_conversion = {
-        'double': 'Decimal',
-        'date': 'Date',
-        'integer': 'Integer',
-        'string': 'String',
-        'xLocation': 'Decimal',
-        'yLocation': 'Decimal',
-        'dropdownEdit': 'String',
-        'dropdown': 'String',
-    }
-    date_fields = []
+    """
+    Creates the import table that datasets are combined into, unless it exists already. The columns, constraints,
+    primary key sequence and index are created directly in one transaction, with the same column types as imported
+    CSVs.
+    """
+
+    table_name = '{}{}{}'.format(TABLE_NAME_PREFIX, dataset_id, IMPORT_SUFFIX)
+    sequence_name = '{}_0_seq'.format(table_name)
+
+    source_dataset_column = convert_header_to_column_name(SOURCE_DATASET_FIELD_NAME)
+    column_types = OrderedDict([(source_dataset_column, IMPORT_COLUMN_TYPES['string'])])
+    required_columns = [PRIMARY_KEY_NAME, source_dataset_column]
+
     for col in row:
         col_name = convert_header_to_column_name(col.column)
-        columns.append(col_name)
-        data_types.append(type_conversion[col.type])
-        if col.type == 'date':
-            date_fields.append(col_name)
-        if hasattr(col, 'required') and not col.required:
-            optional_fields.append(col_name)
-    df = pd.DataFrame(columns=columns)
-    for field in date_fields:
-        df[field] = df[field].astype('datetime64')
-    df_info = {
-        'dataTypes': data_types,
-        'optionalFields': optional_fields
-    }
-    table_name = create_database_table(df, df_info, dataset_id, append=True)
-    with get_sqlalchemy_engine().connect() as conn:
-        sequence_name = '{}_0_seq'.format(table_name)
-        seq_check_query = "SELECT sequence_name FROM information_schema.sequences WHERE sequence_name = '{}'".format(
-            sequence_name
-        )
-        if not conn.execute(seq_check_query).fetchone():
-            conn.execute(
-                'CREATE SEQUENCE {sequence} OWNED BY {table_name}.{pk}'.format(
-                    sequence=sequence_name,
-                    table_name=table_name,
-                    pk=PRIMARY_KEY_NAME
-                )
-            )
-        conn.execute(
-            'ALTER TABLE {table} ALTER COLUMN {key} TYPE bigint USING {key}::bigint'.format(
-                table=table_name, key=PRIMARY_KEY_NAME
-            )
-        )
-        conn.execute(
-            'ALTER TABLE {table} ALTER COLUMN {key} SET DEFAULT nextval(\'{sequence}\')'.format(
-                table=table_name, key=PRIMARY_KEY_NAME, sequence=sequence_name
-            )
-        )
+        column_types[col_name] = IMPORT_COLUMN_TYPES[col.type.lower()]
+        if col.required:
+            required_columns.append(col_name)
+
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute('CREATE TABLE IF NOT EXISTS {table_name} ({pk} bigint, {columns})'.format(
+            table_name=table_name,
+            pk=PRIMARY_KEY_NAME,
+            columns=', '.join('{} {}'.format(k, v) for k, v in column_types.items())
+        ))
+        c.execute('CREATE SEQUENCE IF NOT EXISTS {sequence} OWNED BY {table_name}.{pk}'.format(
+            sequence=sequence_name,
+            table_name=table_name,
+            pk=PRIMARY_KEY_NAME
+        ))
+
+        # The default and all constraints are set by a single ALTER, which locks the table once
+        alter_query = ["ALTER COLUMN {pk} SET DEFAULT nextval('{sequence}')".format(
+            pk=PRIMARY_KEY_NAME, sequence=sequence_name
+        )]
+        alter_query.extend('ALTER COLUMN {} SET NOT NULL'.format(column) for column in required_columns)
+        c.execute('ALTER TABLE {} {}'.format(table_name, ', '.join(alter_query)))
+
+        add_primary_key_index(c, table_name)
+
+    invalidate_fields(table_name)
+
     return table_name
 
 
+def copy_rows_to_table(table, conn, keys, data_iter):
+    """ A ``to_sql`` insertion method that writes rows with ``COPY ... FROM STDIN``, rather than an INSERT each """
+
+    table_name = '{}.{}'.format(table.schema, table.name) if table.schema else table.name
+
+    with conn.connection.cursor() as c:
+        c.copy_expert(
+            'COPY {table_name} ({columns}) FROM STDIN WITH CSV'.format(
+                table_name=table_name,
+                columns=', '.join('"{}"'.format(k) for k in keys)
+            ),
+            CSVRowStream(data_iter),
+            size=COPY_BUFFER_SIZE
+        )
+
+
 def create_database_table(row_set, csv_info, dataset_id, append=False, additional_fields=[]):
+    # GeoAlchemy is only needed to write data frames, so it is not imported until then
+    from geoalchemy2 import Geometry
+
     row_set = prepare_row_set_for_import(row_set, csv_info)
 
     for field in additional_fields:
@@ -1105,7 +1448,9 @@ def create_database_table(row_set, csv_info, dataset_id, append=False, additiona
             conn,
             if_exists=exists_op,
             index_label=PRIMARY_KEY_NAME,
-            dtype={GEOM_FIELD_NAME: Geometry('POINT', srid=WEB_MERCATOR_SRID)}
+            dtype={GEOM_FIELD_NAME: Geometry('POINT', srid=WEB_MERCATOR_SRID)},
+            # Geometries are bound through SQL functions, so only tables without them are copied
+            method=None if GEOM_FIELD_NAME in row_set.columns else copy_rows_to_table
         )
 
         constraints_query = ['ALTER COLUMN {} SET NOT NULL'.format(PRIMARY_KEY_NAME)]
@@ -1115,10 +1460,130 @@ def create_database_table(row_set, csv_info, dataset_id, append=False, additiona
         constraints_query = 'ALTER TABLE {} {}'.format(table_name, ','.join(constraints_query))
         conn.execute(constraints_query)
 
+    invalidate_fields(table_name)
+
+    return table_name
+
+
+def copy_csv_to_database_table(csv_file, csv_info, dataset_id, append=False, additional_fields=[]):
+    """
+    Streams a CSV into the import table for a dataset with ``COPY ... FROM STDIN``. Only the head of the file is
+    read with pandas, to derive the schema, so memory use does not grow with the size of the file.
+    """
+
+    columns, data_types = infer_csv_schema(csv_file, csv_info)
+    if not columns:
+        raise InvalidFileError('File has no columns', lines=0)
+
+    column_types = OrderedDict((c, IMPORT_COLUMN_TYPES[dt.lower()]) for c, dt in zip(columns, data_types))
+
+    # Dates may be in any of the formats detected by describe, including day first ones PostgreSQL would reject.
+    # One format is found for each date column, so that ambiguous values are read the same way in every row.
+    date_indexes = [idx for idx, dt in enumerate(data_types) if dt.lower() == 'date']
+    date_converters = [
+        (idx, iso_date_converter(date_format))
+        for idx, date_format in zip(date_indexes, detect_csv_date_formats(csv_file, date_indexes))
+    ] if date_indexes else []
+
+    # Additional fields fill in missing values for existing columns, or add columns with a constant value
+    fill_values = {}
+    constant_values = []
+    for field in additional_fields:
+        column_name = field.get('name')
+        value = field.get('value')
+        if column_name in column_types:
+            fill_values[columns.index(column_name)] = value
+        else:
+            column_types[column_name] = IMPORT_COLUMN_TYPES[field.get('type').lower()]
+            constant_values.append(value)
+
+    table_name = '{}{}{}'.format(TABLE_NAME_PREFIX, dataset_id, IMPORT_SUFFIX)
+
+    with transaction.atomic(), connection.cursor() as c:
+        if not append:
+            c.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+
+        c.execute('CREATE TABLE IF NOT EXISTS {table_name} ({pk} bigint, {columns})'.format(
+            table_name=table_name,
+            pk=PRIMARY_KEY_NAME,
+            columns=', '.join('{} {}'.format(k, v) for k, v in column_types.items())
+        ))
+
+        c.execute('SELECT MAX({pk}) FROM {table_name}'.format(pk=PRIMARY_KEY_NAME, table_name=table_name))
+        start_index = c.fetchone()[0] or 0
+
+        # Values are passed to COPY as text, so the only per-row work is converting dates to ISO 8601, and adding the
+        # primary key and any additional fields. The generator is chosen once for the import, so rows without fill
+        # values skip that loop entirely.
+        def iter_rows():
+            for pk, row in enumerate(iter_csv_rows(csv_file), start=start_index + 1):
+                for idx, convert_date in date_converters:
+                    row[idx] = convert_date(row[idx])
+                row.insert(0, pk)
+                row.extend(constant_values)
+                yield row
+
+        def iter_filled_rows():
+            fill_items = [(idx + 1, value) for idx, value in fill_values.items()]
+            for row in iter_rows():
+                for idx, value in fill_items:
+                    if row[idx] is None:
+                        row[idx] = value
+                yield row
+
+        with connection.wrap_database_errors:
+            c.cursor.copy_expert(
+                'COPY {table_name} ({pk}, {columns}) FROM STDIN WITH CSV'.format(
+                    table_name=table_name,
+                    pk=PRIMARY_KEY_NAME,
+                    columns=', '.join(column_types)
+                ),
+                CSVRowStream(iter_filled_rows() if fill_values else iter_rows()),
+                size=COPY_BUFFER_SIZE
+            )
+
+        # Optional fields may come from a sample of the file, so other columns are only required if the data
+        # copied has no nulls in them. All of these columns are checked with one scan of the table.
+        required_columns = [column for column in column_types if column not in csv_info['optionalFields']]
+        if required_columns:
+            c.execute('SELECT {has_nulls} FROM {table_name}'.format(
+                has_nulls=', '.join('bool_or({} IS NULL)'.format(column) for column in required_columns),
+                table_name=table_name
+            ))
+            required_columns = [column for column, has_nulls in zip(required_columns, c.fetchone()) if not has_nulls]
+
+        constraints_query = ['ALTER COLUMN {} SET NOT NULL'.format(PRIMARY_KEY_NAME)]
+        constraints_query.extend('ALTER COLUMN {} SET NOT NULL'.format(column) for column in required_columns)
+        c.execute('ALTER TABLE {} {}'.format(table_name, ','.join(constraints_query)))
+
+        # The index is built once the rows are copied, which is cheaper than maintaining it for every row. Tables
+        # appended to are copied from a dataset with its primary key, or created with an index by combine_tables.
+        if not append:
+            add_primary_key_index(c, table_name)
+
+    invalidate_fields(table_name)
+
     return table_name
 
 
-def add_geometry_column(dataset_id, is_import=True):
+def add_primary_key_index(cursor, table_name):
+    """
+    Indexes the primary key column of a table created for an import, if it is not indexed already. The index is
+    named as pandas once named it, so that ``FeatureService.finalize`` renames it with the table.
+    """
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_{table_name}_{pk} ON {table_name} ({pk})'.format(
+        table_name=table_name,
+        pk=PRIMARY_KEY_NAME
+    ))
+
+
+def add_geometry_column(dataset_id, is_import=True, create_index=True):
+    """
+    Adds the geometry column to a dataset table if it does not exist. Pass ``create_index=False`` when the table
+    is about to be bulk populated, and call ``add_geometry_index`` afterwards: building the index once from a full
+    table is much cheaper than maintaining it for every updated row.
+    """
 
     with connection.cursor() as c:
         table_name = '{}{}{}'.format(TABLE_NAME_PREFIX, dataset_id, (IMPORT_SUFFIX if is_import else ''))
@@ -1137,72 +1602,146 @@ def add_geometry_column(dataset_id, is_import=True):
             )
             c.execute(add_command)
 
-            index_command = 'CREATE INDEX {table_name}_geom_index ON {table_name} USING gist({column_name})'.format(
-                table_name=TABLE_NAME_PREFIX + dataset_id + (IMPORT_SUFFIX if is_import else ''),
-                column_name=GEOM_FIELD_NAME
-            )
-            c.execute(index_command)
+    invalidate_fields(table_name)
 
+    if create_index:
+        add_geometry_index(dataset_id, is_import)
+
+
+def add_geometry_index(dataset_id, is_import=True):
 
-def get_fields(for_table):
-    fields = []
     with connection.cursor() as c:
-        c.execute(
-            ' '.join((
-                'SELECT column_name, is_nullable, data_type',
-                'FROM information_schema.columns',
-                'WHERE table_name = %s',
-                'ORDER BY ordinal_position;'
-            )),
-            [for_table]
+        index_command = (
+            'CREATE INDEX IF NOT EXISTS {table_name}_geom_index ON {table_name} USING gist({column_name})'
+        ).format(
+            table_name=TABLE_NAME_PREFIX + dataset_id + (IMPORT_SUFFIX if is_import else ''),
+            column_name=GEOM_FIELD_NAME
         )
-        # c.description won't be populated without first running the query above
-        for field_info in c.fetchall():
-            field_type = field_info[2]
-            fields.append({
-                'name': field_info[0],
-                'alias': field_info[0],
-                'type': POSTGIS_ESRI_FIELD_MAPPING.get(field_type),
-                'nullable': True if field_info[1] == 'YES' else False,
-                'editable': True
-            })
+        c.execute(index_command)
 
-    return fields
 
+def get_fields(for_table):
+    return get_fields_for_tables([for_table])[for_table]
 
-def populate_aggregate_table(aggregate_table_name, columns, datasets_ids_to_combine):
-    delete_command = 'DELETE FROM {0}'.format(aggregate_table_name)
 
-    all_commands = [delete_command]
-    for dataset_id in datasets_ids_to_combine:
+def get_fields_for_tables(table_names):
+    """
+    Reads the fields of several tables with one cache lookup, and one query for any that were not cached.
+    :return: a dictionary of table names to their fields
+    """
+
+    table_names = list(table_names)
+    cache_keys = {FIELDS_CACHE_KEY.format(table_name=table_name): table_name for table_name in table_names}
+    cached = cache.get_many(cache_keys)
 
+    fields_by_table = {table_name: [] for table_name in table_names}
+    fields_by_table.update((cache_keys[key], fields) for key, fields in cached.items())
+
+    uncached = [table_name for table_name in table_names if not fields_by_table[table_name]]
+    if uncached:
         with connection.cursor() as c:
-            c.execute('SELECT * from {table_name} LIMIT 0'.format(
-                table_name=TABLE_NAME_PREFIX + dataset_id
-            ))
-            colnames_in_table = [desc[0].lower() for desc in c.description]
+            c.execute(
+                ' '.join((
+                    'SELECT table_name, column_name, is_nullable, data_type',
+                    'FROM information_schema.columns',
+                    'WHERE table_name IN %s',
+                    'ORDER BY table_name, ordinal_position;'
+                )),
+                [tuple(uncached)]
+            )
+            # c.description won't be populated without first running the query above
+            for field_info in c.fetchall():
+                field_type = field_info[3]
+                fields_by_table[field_info[0]].append({
+                    'name': field_info[1],
+                    'alias': field_info[1],
+                    'type': POSTGIS_ESRI_FIELD_MAPPING.get(field_type),
+                    'nullable': True if field_info[2] == 'YES' else False,
+                    'editable': True
+                })
+
+        # Tables that do not exist yet have no fields, and are not cached. Nor are fields read in a transaction,
+        # which may have changed columns that other requests cannot see yet, or that will be rolled back.
+        if not connection.in_atomic_block:
+            cache.set_many({
+                FIELDS_CACHE_KEY.format(table_name=table_name): fields_by_table[table_name]
+                for table_name in uncached if fields_by_table[table_name]
+            }, FIELDS_CACHE_TIMEOUT)
+
+    # Callers annotate the field dicts they are given, so the cached ones are copied
+    return {table_name: [dict(field) for field in fields] for table_name, fields in fields_by_table.items()}
+
+
+def invalidate_fields(*table_names):
+    """
+    Clears cached fields for tables whose columns have been created, changed or dropped. Inside a transaction, they
+    are cleared again once it commits, since other requests may cache the old columns until then.
+    """
+
+    _clear_fields(table_names)
+    if connection.in_atomic_block:
+        transaction.on_commit(partial(_clear_fields, table_names))
+
+
+def _clear_fields(table_names):
+    cache.delete_many([FIELDS_CACHE_KEY.format(table_name=table_name) for table_name in table_names])
+    invalidate_table_data(*table_names)
+
+
+def get_table_version(table_name):
+    """ :return: a token identifying the current data in a table, for keying results cached from it """
+
+    key = TABLE_VERSION_CACHE_KEY.format(table_name=table_name)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            # Another request set the version first
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate_table_data(*table_names):
+    """ Replaces the version of tables whose rows have changed, so that results cached from them are not used """
+    cache.delete_many([TABLE_VERSION_CACHE_KEY.format(table_name=table_name) for table_name in table_names])
 
-        current_columns = [column for column in columns if column.column.lower() in colnames_in_table]
+
+def populate_aggregate_table(aggregate_table_name, columns, datasets_ids_to_combine):
+    dataset_tables = OrderedDict((TABLE_NAME_PREFIX + dataset_id, dataset_id) for dataset_id in datasets_ids_to_combine)
+
+    with transaction.atomic(), connection.cursor() as c:
+
+        # Read the columns of all the source tables at once, rather than querying each table in turn
+        colnames_in_tables = {}
+        if dataset_tables:
+            c.execute(
+                'SELECT table_name, column_name FROM information_schema.columns WHERE table_name IN %s',
+                [tuple(dataset_tables)]
+            )
+            for table_name, column_name in c.fetchall():
+                colnames_in_tables.setdefault(table_name, set()).add(column_name.lower())
+
+        c.execute('TRUNCATE {0}'.format(aggregate_table_name))
 
         # Data has already been successfully imported: no need for robust error handling
 
-        insert_command = (
-            'INSERT INTO {table_name} ({definition_fields} {source_dataset}, {spatial_field}) '
-            'SELECT {definition_fields} {dataset_id}, {spatial_field} FROM {dataset_table}'
-        ).format(
-            table_name=aggregate_table_name,
-            definition_fields=','.join([column.column for column in current_columns]) + ',' if current_columns else '',
-            source_dataset=SOURCE_DATASET_FIELD_NAME,
-            dataset_id="'{0}'".format(dataset_id),
-            dataset_table=TABLE_NAME_PREFIX + dataset_id,
-            spatial_field=GEOM_FIELD_NAME
-        )
+        for dataset_table, dataset_id in dataset_tables.items():
+            colnames_in_table = colnames_in_tables.get(dataset_table, set())
+            current_columns = [column.column for column in columns if column.column.lower() in colnames_in_table]
 
-        all_commands.append(insert_command)
+            insert_command = (
+                'INSERT INTO {table_name} ({definition_fields} {source_dataset}, {spatial_field}) '
+                'SELECT {definition_fields} %s, {spatial_field} FROM {dataset_table}'
+            ).format(
+                table_name=aggregate_table_name,
+                definition_fields=','.join(current_columns) + ',' if current_columns else '',
+                source_dataset=SOURCE_DATASET_FIELD_NAME,
+                dataset_table=dataset_table,
+                spatial_field=GEOM_FIELD_NAME
+            )
+            c.execute(insert_command, [dataset_id])
 
-    with connection.cursor() as c:
-        for command in all_commands:
-            c.execute(command)
+        transaction.on_commit(partial(invalidate_table_data, aggregate_table_name))
 
 
 def populate_point_data(pk, srid, x_column, y_column, is_import=True):
@@ -1218,18 +1757,26 @@ def populate_point_data(pk, srid, x_column, y_column, is_import=True):
             geo_srid=WEB_MERCATOR_SRID
         )
 
-    update_command = 'UPDATE {table_name} SET {field_name} = {make_point_command}'.format(
-        table_name=TABLE_NAME_PREFIX + pk + (IMPORT_SUFFIX if is_import else ''),
+    table_name = TABLE_NAME_PREFIX + pk + (IMPORT_SUFFIX if is_import else '')
+
+    # Rows without coordinates cannot have a geometry, so they are removed before the points are built
+    clear_null_command = (
+        'DELETE FROM {table_name} WHERE {field_name} IS NULL AND ({x_column} IS NULL OR {y_column} IS NULL)'
+    ).format(
+        table_name=table_name,
         field_name=GEOM_FIELD_NAME,
-        make_point_command=make_point_command
+        x_column=x_column,
+        y_column=y_column
     )
 
-    clear_null_command = 'DELETE FROM {table_name} WHERE {field_name} IS NULL'.format(
-        table_name=TABLE_NAME_PREFIX + pk + (IMPORT_SUFFIX if is_import else ''),
+    # Only rows without a geometry are updated, so appending data does not rebuild existing points
+    update_command = 'UPDATE {table_name} SET {field_name} = {make_point_command} WHERE {field_name} IS NULL'.format(
+        table_name=table_name,
         field_name=GEOM_FIELD_NAME,
+        make_point_command=make_point_command
     )
 
     # Data has already been proven by populate_data: no need for robust error handling
     with connection.cursor() as c:
-        c.execute(update_command)
         c.execute(clear_null_command)
+        c.execute(update_command)
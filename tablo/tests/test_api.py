@@ -0,0 +1,145 @@
+import datetime
+import json
+
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from tastypie.models import ApiKey
+from tastypie.serializers import Serializer
+
+from tablo.api import API_KEY_CACHE_KEY, CachedApiKeyAuthentication, OrjsonSerializer, STREAMING_LIST_THRESHOLD
+from tablo.models import FeatureService, FeatureServiceLayer
+
+API_KEY = 'secretkey'
+USERNAME = 'admin'
+
+API_URL_LAYERS = '/api/v1/featureservicelayer/'
+
+LAYER_FIELDS = [
+    {'name': 'db_id', 'alias': 'db_id', 'type': 'esriFieldTypeInteger', 'nullable': False, 'editable': True},
+    {'name': 'name', 'alias': 'name', 'type': 'esriFieldTypeString', 'nullable': True, 'editable': True}
+]
+
+
+class TestCachedApiKeyAuthentication(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username=USERNAME, password='123456')
+        self.api_key = ApiKey.objects.create(user=self.user, key=API_KEY)
+        self.auth = CachedApiKeyAuthentication()
+
+    def authenticate(self, key=API_KEY):
+        request = RequestFactory().get(API_URL_LAYERS, HTTP_AUTHORIZATION='ApiKey {}:{}'.format(USERNAME, key))
+        return request, self.auth.is_authenticated(request)
+
+    def test_cache_hit_sets_user(self):
+        self.assertIs(self.authenticate()[1], True)
+        self.assertIsNotNone(cache.get(API_KEY_CACHE_KEY.format(username=USERNAME)))
+
+        with patch('tastypie.authentication.ApiKeyAuthentication.is_authenticated') as is_authenticated:
+            request, authenticated = self.authenticate()
+            self.assertFalse(is_authenticated.called)
+
+        self.assertIs(authenticated, True)
+        self.assertEqual(request.user, self.user)
+
+    def test_wrong_key_rejected_when_cached(self):
+        self.assertIs(self.authenticate()[1], True)
+        self.assertIsNot(self.authenticate('wrongkey')[1], True)
+
+    def test_regenerated_key_invalidates_cache(self):
+        self.assertIs(self.authenticate()[1], True)
+
+        self.api_key.key = 'newkey'
+        self.api_key.save()
+
+        self.assertIsNone(cache.get(API_KEY_CACHE_KEY.format(username=USERNAME)))
+        self.assertIsNot(self.authenticate()[1], True)
+        self.assertIs(self.authenticate('newkey')[1], True)
+
+    def test_deactivated_user_invalidates_cache(self):
+        self.assertIs(self.authenticate()[1], True)
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(cache.get(API_KEY_CACHE_KEY.format(username=USERNAME)))
+        self.assertIsNot(self.authenticate()[1], True)
+
+
+class TestOrjsonSerializer(TestCase):
+
+    def test_to_json_matches_default_serializer(self):
+        data = {
+            'created': datetime.datetime(2019, 12, 25, 10, 30, 15),
+            'day': datetime.date(2019, 12, 25),
+            'time': datetime.time(10, 30),
+            'amount': Decimal('1.10'),
+            'nested': [{'b': Decimal('2'), 'a': None}, 'text', 3, 4.5, True]
+        }
+
+        self.assertEqual(
+            json.loads(OrjsonSerializer().to_json(data)),
+            json.loads(Serializer(formats=['json']).to_json(data))
+        )
+
+
+class TestFeatureServiceLayerList(TestCase):
+
+    def setUp(self):
+        # Users authenticated by API key are cached, so none are carried over from other tests
+        cache.clear()
+
+        user = User.objects.create_user(username=USERNAME, password='123456', is_superuser=True)
+        ApiKey.objects.create(user=user, key=API_KEY)
+
+        service = FeatureService.objects.create(spatial_reference=json.dumps({'wkid': 3857}))
+        FeatureServiceLayer.objects.bulk_create([
+            FeatureServiceLayer(
+                service=service,
+                layer_order=idx,
+                table='db_table_{}'.format(idx),
+                name='Layer {}'.format(idx),
+                geometry_type='esriGeometryPoint',
+                drawing_info='{}'
+            )
+            for idx in range(STREAMING_LIST_THRESHOLD + 1)
+        ])
+
+    def get_layers(self):
+        with patch('tablo.models.get_fields_for_tables') as get_fields_for_tables:
+            get_fields_for_tables.side_effect = lambda table_names: {t: LAYER_FIELDS for t in table_names}
+            return self.client.get(
+                API_URL_LAYERS,
+                data={'format': 'json', 'limit': 0},
+                HTTP_AUTHORIZATION='ApiKey {}:{}'.format(USERNAME, API_KEY)
+            )
+
+    def test_streamed_list_matches_list(self):
+        resp = self.get_layers()
+        self.assertTrue(resp.streaming)
+        streamed = json.loads(b''.join(resp.streaming_content).decode())
+
+        with patch('tablo.api.STREAMING_LIST_THRESHOLD', STREAMING_LIST_THRESHOLD * 2):
+            resp = self.get_layers()
+        self.assertFalse(resp.streaming)
+
+        self.assertEqual(len(streamed['objects']), STREAMING_LIST_THRESHOLD + 1)
+        self.assertEqual(streamed, json.loads(resp.content.decode()))
+
+    def test_streamed_list_applies_alter_list_data_to_serialize(self):
+        def alter_list_data_to_serialize(resource, request, data):
+            data['meta']['altered'] = True
+            return data
+
+        with patch(
+            'tablo.api.FeatureServiceLayerResource.alter_list_data_to_serialize', alter_list_data_to_serialize
+        ):
+            resp = self.get_layers()
+
+        self.assertTrue(json.loads(b''.join(resp.streaming_content).decode())['meta']['altered'])
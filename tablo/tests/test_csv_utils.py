@@ -2,7 +2,10 @@ import io
 
 from django.test import TestCase
 
-from tablo.csv_utils import prepare_csv_rows, convert_header_to_column_name
+import pandas as pd
+
+from tablo.csv_utils import prepare_csv_rows, convert_header_to_column_name, infer_csv_schema, iter_csv_rows
+from tablo.csv_utils import detect_csv_date_formats, detect_date_format, iso_date_converter
 
 
 class TestCSVUtils(TestCase):
@@ -20,6 +23,78 @@ class TestCSVUtils(TestCase):
         self.assertEqual(dtypes[2].lower(), 'empty')
         self.assertEqual(dtypes[3].lower(), 'decimal')
 
+    def test_date_type_inference(self):
+        test_csv_file = io.StringIO(
+            'header_one,header_two,header_three\n'
+            ',01/02/2019,2019-01-01\n'
+            '2019-01-01,13/02/2019,not a date\n'
+        )
+        prepared_csv = prepare_csv_rows(test_csv_file)
+        self.assertEqual(prepared_csv['data_types'], ['Date', 'Date', 'String'])
+
+    def test_iso_date_converter(self):
+        convert_date = iso_date_converter('%d/%m/%Y')
+        self.assertEqual(convert_date('25/12/2019'), '2019-12-25T00:00:00')
+        self.assertEqual(convert_date('01/02/2019'), '2019-02-01T00:00:00')
+
+        # Values that do not match the format of the column are parsed by pandas
+        self.assertEqual(convert_date('2019-01-05 10:30:00'), '2019-01-05T10:30:00')
+        self.assertIsNone(convert_date(None))
+
+        # Ambiguous year first dates are ISO 8601
+        date_format = detect_date_format(pd.Series(['2019-01-05']))
+        self.assertEqual(date_format, '%Y-%m-%d')
+        self.assertEqual(iso_date_converter(date_format)('2019-01-05'), '2019-01-05T00:00:00')
+        self.assertEqual(iso_date_converter()('2019-01-05'), '2019-01-05T00:00:00')
+
+    def test_detect_csv_date_formats(self):
+        # The format is found from the whole column, so it does not depend on which rows come first
+        test_csv_file = io.StringIO(
+            'name,observed,created\n'
+            'one,01/02/2019,2019-01-05\n'
+            'two,25/12/2019,\n'
+            'three,,2019-01-31\n'
+        )
+        self.assertEqual(detect_csv_date_formats(test_csv_file, [1, 2]), ['%d/%m/%Y', '%Y-%m-%d'])
+
+    def test_iter_csv_rows(self):
+        test_csv_file = io.StringIO(
+            'header_one,header_two,,header_three\n'
+            ' one ,1,skipped,NA\n'
+            '\n'
+            ',,,\n'
+            '"two, three",2,skipped,2.1\n'
+        )
+        rows = list(iter_csv_rows(test_csv_file))
+        self.assertEqual(rows, [['one', '1', None], ['two, three', '2', '2.1']])
+
+    def test_infer_csv_schema(self):
+        test_csv_file = io.BytesIO(
+            '\ufeffHeader One,header-two,,3\n'
+            'one,1,skipped,2019-01-01\n'.encode()
+        )
+        columns, data_types = infer_csv_schema(test_csv_file)
+        self.assertEqual(columns, ['header_one', 'header_two', 'f_3'])
+        self.assertEqual(data_types, ['String', 'Integer', 'Date'])
+
+        # Given data types are used as they are, and only the header is read
+        columns, data_types = infer_csv_schema(test_csv_file, {'dataTypes': ['String', 'Decimal', 'String']})
+        self.assertEqual(columns, ['header_one', 'header_two', 'f_3'])
+        self.assertEqual(data_types, ['String', 'Decimal', 'String'])
+
+    def test_infer_csv_schema_duplicate_headers(self):
+        # Duplicate headers are made unique in the same way whether the schema is inferred or only the header is read
+        test_csv_file = io.BytesIO(
+            'name,name,,when\n'
+            'one,two,skipped,2019-01-01\n'.encode()
+        )
+        columns, _ = infer_csv_schema(test_csv_file)
+        self.assertEqual(columns, ['name', 'name1', 'when_a'])
+        self.assertEqual(columns, list(prepare_csv_rows(test_csv_file)['row_set'].columns))
+
+        columns, _ = infer_csv_schema(test_csv_file, {'dataTypes': ['String', 'String', 'Date']})
+        self.assertEqual(columns, ['name', 'name1', 'when_a'])
+
     def test_convert_header_to_column_name(self):
         test_cases = [
             ('header', 'header'),
@@ -3,13 +3,14 @@ import random
 import string
 
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
 from django.db import connection
 from django.test import TestCase
 from django.utils.timezone import datetime
 
 from tastypie.models import ApiKey
 
-from tablo.models import FeatureService, FeatureServiceLayer
+from tablo.models import Column, FeatureService, FeatureServiceLayer, TemporaryFile, create_aggregate_database_table
 from tablo.utils import json_date_serializer
 
 API_KEY = 'secretkey'
@@ -19,6 +20,8 @@ PASSWORD = '123456'
 # API Urls
 API_URL_READ = '/tablo/arcgis/rest/services/{feature_id}/FeatureServer/0/query/'
 API_URL_EDIT = '/api/v1/featureservice/{feature_id}/apply-edits/'
+API_URL_COPY = '/api/v1/featureservice/{feature_id}/copy/'
+API_URL_DEPLOY = '/api/v1/temporary-files/{uuid}/{dataset_id}/deploy/'
 
 """Datasets props
 {
@@ -93,6 +96,20 @@ class TestCRUD(TestCase):
     def get_api_key(self):
         return 'ApiKey {user}:{api_key}'.format(user=USERNAME, api_key=API_KEY)
 
+    def create_temporary_file(self, content):
+        temporary_file = TemporaryFile(filename='test.csv', filesize=len(content))
+        temporary_file.file.save('test.csv', ContentFile(content.encode()))
+        self.addCleanup(temporary_file.file.storage.delete, temporary_file.file.name)
+        return temporary_file
+
+    def deploy(self, temporary_file, dataset_id, csv_info):
+        User.objects.filter(username=USERNAME).update(is_superuser=True)
+        return self.client.post(
+            API_URL_DEPLOY.format(uuid=temporary_file.uuid, dataset_id=dataset_id),
+            data={'csv_info': json.dumps(csv_info), 'fields': json.dumps([])},
+            HTTP_AUTHORIZATION=self.get_api_key()
+        )
+
     def dataset_modifier(self, geom_type, data):
         resp = self.client.post(
             API_URL_EDIT.format(feature_id=getattr(self, 'feature_service_{}'.format(geom_type)).id),
@@ -189,6 +206,122 @@ class TestCRUD(TestCase):
         for p in self.dataset_modifier('point', {'adds': json.dumps(data)})['addResults']:
             self.assertTrue(p.get('success'))
 
+    def test_add_points_atomic_rolls_back_all(self):
+        # with atomic=1, one invalid point must roll back the valid points added with it
+        data = self.generate_random_data({'prop1': 'int', 'prop2': 'int'}, 4, 'point', True)
+        data += self.generate_random_data({'prop1': 'int'}, 1, 'point', True)
+        with connection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM db_point_test')
+            original_count = cur.fetchone()[0]
+
+        resp = self.client.post(
+            API_URL_EDIT.format(feature_id=self.feature_service_point.id) + '?atomic=1',
+            data={'adds': json.dumps(data)},
+            HTTP_AUTHORIZATION=self.get_api_key()
+        )
+        for p in json.loads(resp.content.decode('utf8'))['addResults']:
+            self.assertFalse(p.get('success'))
+
+        with connection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM db_point_test')
+            self.assertEqual(cur.fetchone()[0], original_count)
+
+    def test_copy_points_keeps_extents(self):
+        # a copied service must carry over the cached extents of the original, rather than recompute them
+        extent = json.dumps({'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4, 'spatialReference': {'wkid': 3857}})
+        FeatureService.objects.filter(id=self.feature_service_point.id).update(
+            _initial_extent=extent, _full_extent=extent
+        )
+        # the time extent is not cached, so it is computed for the response from the copied layer
+        FeatureServiceLayer.objects.filter(id=self.feature_service_layer_point.id).update(
+            _extent=extent, supports_time=True, start_time_field='db_created_date', _time_extent=None
+        )
+
+        resp = self.client.post(
+            API_URL_COPY.format(feature_id=self.feature_service_point.id),
+            HTTP_AUTHORIZATION=self.get_api_key()
+        )
+        resp_data = json.loads(resp.content.decode('utf8'))
+        copied_service = FeatureService.objects.get(id=resp_data['service_id'])
+        copied_layer = copied_service.featureservicelayer_set.get()
+
+        self.assertNotEqual(copied_service.id, self.feature_service_point.id)
+        self.assertEqual(copied_service._initial_extent, extent)
+        self.assertEqual(copied_service._full_extent, extent)
+        self.assertEqual(copied_layer._extent, extent)
+        self.assertIsNotNone(resp_data['time_extent'])
+        self.assertEqual(copied_layer._time_extent, resp_data['time_extent'])
+
+    def test_deploy_day_first_dates(self):
+        # dates described in a day first format must be loaded as those dates, rather than rejected by the database
+        temporary_file = self.create_temporary_file(
+            'name,observed,lon,lat\n'
+            'one,25/12/2019,-120.5,44.1\n'
+            'two,01/02/2019,-121.0,45.2\n'
+        )
+        resp = self.deploy(temporary_file, 'day_first', {
+            'fieldNames': ['name', 'observed', 'lon', 'lat'],
+            'dataTypes': ['String', 'Date', 'Decimal', 'Decimal'],
+            'optionalFields': [],
+            'xColumn': 'lon',
+            'yColumn': 'lat',
+            'srid': 4326
+        })
+        self.assertEqual(resp.status_code, 200)
+
+        with connection.cursor() as cur:
+            cur.execute('SELECT observed FROM db_day_first_import ORDER BY db_id')
+            self.assertEqual([row[0] for row in cur.fetchall()], [datetime(2019, 12, 25), datetime(2019, 2, 1)])
+
+    def test_deploy_nulls_in_required_field(self):
+        # blank values missed by the sample that described the file must leave the column nullable
+        temporary_file = self.create_temporary_file(
+            'name,lon,lat\n'
+            'one,-120.5,44.1\n'
+            ',-121.0,45.2\n'
+        )
+        resp = self.deploy(temporary_file, 'nulls', {
+            'fieldNames': ['name', 'lon', 'lat'],
+            'dataTypes': ['String', 'Decimal', 'Decimal'],
+            'optionalFields': [],
+            'xColumn': 'lon',
+            'yColumn': 'lat',
+            'srid': 4326
+        })
+        self.assertEqual(resp.status_code, 200)
+
+        with connection.cursor() as cur:
+            cur.execute(
+                "SELECT column_name, is_nullable FROM information_schema.columns "
+                "WHERE table_name = 'db_nulls_import' AND column_name IN ('db_id', 'name', 'lon')"
+            )
+            self.assertEqual(dict(cur.fetchall()), {'db_id': 'NO', 'name': 'YES', 'lon': 'NO'})
+
+    def test_deploy_indexes_primary_key(self):
+        # features are looked up by db_id, so deployed tables must index it under a name renamed with the table
+        temporary_file = self.create_temporary_file('name,lon,lat\none,-120.5,44.1\n')
+        resp = self.deploy(temporary_file, 'indexed', {
+            'fieldNames': ['name', 'lon', 'lat'],
+            'dataTypes': ['String', 'Decimal', 'Decimal'],
+            'optionalFields': [],
+            'xColumn': 'lon',
+            'yColumn': 'lat',
+            'srid': 4326
+        })
+        self.assertEqual(resp.status_code, 200)
+
+        with connection.cursor() as cur:
+            cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_db_indexed_import_db_id'")
+            self.assertIn('(db_id)', cur.fetchone()[0])
+
+    def test_aggregate_table_indexes_primary_key(self):
+        # tables that datasets are combined into must index db_id as deployed tables do
+        create_aggregate_database_table([Column('name', 'string')], 'combined')
+
+        with connection.cursor() as cur:
+            cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_db_combined_import_db_id'")
+            self.assertIn('(db_id)', cur.fetchone()[0])
+
     def test_update_points_fail_wrong_attr(self):
         # updating existing points must fail due to wrong attribute (prop3)
         data = self.generate_random_data({'prop3': 'int'}, 5)
@@ -218,6 +351,22 @@ class TestCRUD(TestCase):
         for p in self.dataset_modifier('point', {'deletes': '1,2,3,4,5,6'})['deleteResults']:
             self.assertTrue(p.get('success'))
 
+    def test_apply_no_edits(self):
+        # a request without edits must return empty results without changing the dataset
+        self.assertEqual(
+            self.dataset_modifier('point', {'adds': '[]', 'deletes': ''}),
+            {'addResults': [], 'updateResults': [], 'deleteResults': []}
+        )
+
+    def test_delete_points_fail_invalid_id(self):
+        # deleting must be rejected when an object id is not an integer
+        resp = self.client.post(
+            API_URL_EDIT.format(feature_id=self.feature_service_point.id),
+            data={'deletes': '1,two'},
+            HTTP_AUTHORIZATION=self.get_api_key()
+        )
+        self.assertEqual(resp.status_code, 400)
+
     # Polyline tests
     def test_read_polylines(self):
         # makes sure data returned from api matches entries in db_polyline_test
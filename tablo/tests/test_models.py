@@ -1,9 +1,14 @@
+import io
+
 from collections import OrderedDict
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 from unittest.mock import patch, PropertyMock
 
-from tablo.exceptions import RelatedFieldsError
+from tablo.exceptions import InvalidFileError, RelatedFieldsError
 from tablo.models import FeatureService, FeatureServiceLayer, FeatureServiceLayerRelations
+from tablo.models import FIELDS_CACHE_KEY, copy_csv_to_database_table, get_fields, invalidate_fields
 
 
 TABLE_NAME = 'db_table'
@@ -246,3 +251,102 @@ class PerformQueryTestCase(TestCase):
         with patch('tablo.models.connection') as mockconnection:
             layer.perform_query(**perform_query_args)
             mockconnection.cursor().__enter__().execute.assert_called_with(expected_sql, expected_sql_args)
+
+
+class CopyCSVTestCase(TestCase):
+
+    def test_no_columns(self):
+        # a file without a header must be rejected before any table is created
+        csv_info = {'dataTypes': ['String'], 'optionalFields': []}
+        with self.assertRaises(InvalidFileError):
+            copy_csv_to_database_table(io.BytesIO(b'\n'), csv_info, 'no_columns')
+
+
+class CachedExtentTestCase(TestCase):
+
+    def setUp(self):
+        feature_service = FeatureService.objects.create(description='FeatureServiceTestOne')
+        self.feature_service_layer = FeatureServiceLayer.objects.create(
+            service=feature_service,
+            layer_order=0,
+            table=TABLE_NAME,
+            name='FeatureServiceLayerTestOne',
+            object_id_field='db_id',
+            supports_time=True,
+            start_time_field='start_date',
+            _extent='{"xmin": 0, "ymin": 0, "xmax": 1, "ymax": 1}',
+            _time_extent='[0, 1]'
+        )
+
+    def test_time_field_change_clears_time_extent(self):
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        layer.start_time_field = 'end_date'
+        layer.save()
+
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        self.assertIsNone(layer._time_extent)
+        self.assertIsNotNone(layer._extent)
+
+    def test_table_change_clears_extents(self):
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        layer.table = 'db_other_table'
+        layer.save(update_fields=['table'])
+
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        self.assertIsNone(layer._time_extent)
+        self.assertIsNone(layer._extent)
+
+    def test_other_changes_keep_extents(self):
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        layer.name = 'Renamed'
+        layer.save()
+
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        self.assertEqual(layer._time_extent, '[0, 1]')
+        self.assertIsNotNone(layer._extent)
+
+
+    def test_set_loaded_values_keeps_extents(self):
+        # a layer whose new table is stored without save, as by bulk_create, must keep the extents it carries
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        layer.table = 'db_other_table'
+        FeatureServiceLayer.objects.filter(id=layer.id).update(table=layer.table)
+        layer.set_loaded_values()
+        layer.save(update_fields=['name'])
+
+        layer = FeatureServiceLayer.objects.get(id=self.feature_service_layer.id)
+        self.assertEqual(layer._time_extent, '[0, 1]')
+        self.assertIsNotNone(layer._extent)
+
+class FieldsCacheTestCase(TransactionTestCase):
+
+    def test_invalidate_fields_on_commit(self):
+        cache_key = FIELDS_CACHE_KEY.format(table_name=TABLE_NAME)
+
+        with transaction.atomic():
+            invalidate_fields(TABLE_NAME)
+
+            # Another request caches the columns it can still see before the change is committed
+            cache.set(cache_key, [{'name': 'old_column'}])
+
+        self.assertIsNone(cache.get(cache_key))
+
+    def test_fields_cached_outside_transaction(self):
+        # Fields read outside of a transaction are cached until the table is invalidated
+        table_name = FeatureService._meta.db_table
+        cache_key = FIELDS_CACHE_KEY.format(table_name=table_name)
+        cache.delete(cache_key)
+
+        with self.assertNumQueries(1):
+            fields = get_fields(table_name)
+        self.assertIn('id', [field['name'] for field in fields])
+        self.assertIsNotNone(cache.get(cache_key))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_fields(table_name), fields)
+
+        invalidate_fields(table_name)
+        self.assertIsNone(cache.get(cache_key))
+
+        with self.assertNumQueries(1):
+            get_fields(table_name)
@@ -1,14 +1,14 @@
-import json
-
 from collections import OrderedDict
 
 from django.db import connection
 
-from sqlalchemy import create_engine
-
 
 def get_sqlalchemy_engine():
     """ Return a SQLAlchemy engine object from Django database settings """
+
+    # SQLAlchemy is only needed to write data frames, so it is not imported until then
+    from sqlalchemy import create_engine
+
     settings = connection.settings_dict
     user = settings.get('USER')
     password = settings.get('PASSWORD')
@@ -135,4 +135,4 @@ def json_date_serializer(obj):
     if hasattr(obj, 'isoformat'):
         serial = obj.isoformat()
         return serial
-    return json.JSONEncoder.default(obj)
+    raise TypeError('Object of type {0} is not JSON serializable'.format(type(obj).__name__))
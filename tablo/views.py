@@ -1,4 +1,3 @@
-import json
 import shutil
 import tempfile
 
@@ -14,6 +13,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from django.views.generic.edit import ProcessFormView, FormMixin
 
+from . import json_compat
 from .forms import TemporaryFileForm
 from .models import TemporaryFile
 
@@ -39,7 +39,7 @@ class TemporaryFileUploadViewBase(View):
         tmp_file.save()
 
         data = {'uuid': str(tmp_file.uuid)}
-        response = HttpResponse(json.dumps(data), status=201)
+        response = HttpResponse(json_compat.dumps(data), status=201)
         response['Content-type'] = "text/plain"
 
         return response
@@ -24,7 +24,14 @@ def to_esri_feature(wkt):
             wkt.replace(geom_type, '')
         ).replace('(', '[' * bracket_multiplier).replace(')', ']' * bracket_multiplier))
 
-    if geom_type == 'POINT' or geom_type == 'MULTIPOINT':
+    if geom_type == 'POINT':
+        # Points are by far the most common geometry, and their coordinates are simply split rather than matched
+        try:
+            x, y = map(float, wkt[6:-1].split())
+        except ValueError:
+            raise ValueError('Invalid Point Geometry: {0}'.format(wkt))
+        return {'x': x, 'y': y}
+    elif geom_type == 'MULTIPOINT':
         match = WKT_GEOM_REGEX.findall(wkt)
         if len(match) != 1:
             raise ValueError('Invalid Point Geometry: {0}'.format(wkt))